@@ -0,0 +1,221 @@
+import argparse
+import csv
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+import ping_logs
+from ping_stats import PERCENTILES
+
+SAMPLE_LINE = re.compile(r"^Sent: ([^,\n]+), Received: ([^\n]+)$", re.MULTILINE)
+COLUMNS = ["by", "key", "pings", "lost %", "mean", "std", "min"] + [f"p{p}" for p in PERCENTILES] + ["max", "jitter"]
+
+
+def _segment(region, send_us, rtt_ms, lost):
+    """
+    Sort a region block by send time and add the absolute RTT difference to the previous answered
+    ping, the per-sample term of the jitter (NaN for lost pings and the first reply).
+    """
+    order = np.argsort(send_us, kind="stable")
+    send_us, rtt_ms, lost = send_us[order], rtt_ms[order], lost[order]
+    deltas = np.full(len(rtt_ms), np.nan)
+    answered = np.flatnonzero(~lost)
+    deltas[answered[1:]] = np.abs(np.diff(rtt_ms[answered]))
+    return region, send_us, rtt_ms, lost, deltas
+
+
+def _load_text(file_name):
+    with ping_logs.open_log(file_name, 'r') as file:
+        content = file.read()
+    segments = []
+    for block in content.split("Region: ")[1:]:
+        region = block.partition("\n")[0]
+        # NumPy parses the ISO timestamps in C, which is what makes big corpora fast
+        times = np.array(SAMPLE_LINE.findall(block), dtype="datetime64[us]").reshape(-1, 2).astype(np.int64)
+        rtt_ms = (times[:, 1] - times[:, 0]) / 1000.0
+        segments.append(_segment(region, times[:, 0], rtt_ms, np.zeros(len(times), bool)))
+    return segments
+
+
+def _load_binary(file_name):
+    """
+    Return whether the file lists its lost pings (not when it was converted from text) and its segments.
+    """
+    segments = []
+    known_loss = True
+    for region in ping_logs.read_binary_log(file_name):
+        known_loss &= ping_logs.LOSS_UNKNOWN not in region.header_lines
+        wall_us = (region.anchor[0] - region.anchor[1] + np.asarray(region.send_ns, np.int64)) // 1000
+        # Local time like the text format, so the hours of both formats line up
+        first = datetime.fromtimestamp(int(wall_us[0]) // 1000000 if len(wall_us) else 0)
+        offset_us = int(first.astimezone().utcoffset().total_seconds()) * 1000000
+        lost = np.asarray(region.status) != ping_logs.OK
+        rtt_ms = np.where(lost, np.nan, np.asarray(region.rtt_ns, np.int64) / 1e6)
+        segments.append(_segment(region.region, wall_us + offset_us, rtt_ms, lost))
+    return known_loss, segments
+
+
+def load_file(file_name):
+    """
+    Parse one results file into NumPy columns per region block.
+    Return whether the file records lost pings (only binary files not converted from text do) and a list of
+    (region, send_us, rtt_ms, lost, jitter deltas) tuples, send_us being local wall clock time.
+    """
+    with ping_logs.open_log(file_name) as file:
+        binary = file.read(len(ping_logs.MAGIC)) == ping_logs.MAGIC
+    if binary:
+        return _load_binary(file_name)
+    return False, _load_text(file_name)
+
+
+def load_corpus(file_names, workers=None):
+    """
+    Parse the files in a process pool and concatenate them into one set of columns.
+    """
+    if workers == 1:
+        loaded = map(load_file, file_names)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        loaded = pool.map(load_file, file_names, chunksize=max(1, len(file_names) // (4 * (workers or os.cpu_count() or 1))))
+    regions = {}
+    parts = {"region": [], "file": [], "send_us": [], "rtt_ms": [], "lost": [], "deltas": [], "known_loss": []}
+    for file_index, (known_loss, segments) in enumerate(loaded):
+        for region, send_us, rtt_ms, lost, deltas in segments:
+            parts["region"].append(np.full(len(send_us), regions.setdefault(region, len(regions))))
+            parts["file"].append(np.full(len(send_us), file_index))
+            parts["send_us"].append(send_us)
+            parts["rtt_ms"].append(rtt_ms)
+            parts["lost"].append(lost)
+            parts["deltas"].append(deltas)
+            parts["known_loss"].append(np.full(len(send_us), known_loss))
+    if workers != 1:
+        pool.shutdown()
+    empty = {"region": np.int64, "file": np.int64, "send_us": np.int64, "rtt_ms": float, "lost": bool,
+             "deltas": float, "known_loss": bool}
+    columns = {name: np.concatenate(part) if part else np.zeros(0, empty[name]) for name, part in parts.items()}
+    columns["region_names"] = list(regions)
+    return columns
+
+
+def summarize(keys, labels, columns):
+    """
+    Distribution, loss and jitter per group in a handful of vectorized passes: one sort by
+    (group, rtt) gives every group's percentiles by indexing, bincount gives the sums.
+    keys holds the group index of every sample, labels the name of every group.
+    """
+    groups = len(labels)
+    lost = columns["lost"]
+    answered = ~lost
+    keys_answered = keys[answered]
+    rtt = columns["rtt_ms"][answered]
+
+    count = np.bincount(keys_answered, minlength=groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(keys_answered, rtt, groups) / count
+        squares = np.bincount(keys_answered, (rtt - mean[keys_answered]) ** 2, groups)
+        std = np.sqrt(squares / (count - 1))
+
+        order = np.lexsort((rtt, keys_answered))
+        ordered = rtt[order]
+        starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+        ends = np.maximum(starts + count - 1, 0)
+        has_data = count > 0
+
+        def at(q):
+            # Linear interpolation between the closest ranks, like numpy.percentile
+            position = starts + q * np.maximum(count - 1, 0)
+            low = np.floor(position).astype(np.int64)
+            high = np.minimum(low + 1, ends)
+            fraction = position - low
+            values = np.full(groups, np.nan)
+            values[has_data] = (ordered[low[has_data]] * (1 - fraction[has_data])
+                                + ordered[high[has_data]] * fraction[has_data])
+            return values
+
+        known = columns["known_loss"]
+        sent_known = np.bincount(keys[known], minlength=groups)
+        loss = 100.0 * np.bincount(keys[known], lost[known], groups) / sent_known
+
+        deltas = columns["deltas"]
+        valid = ~np.isnan(deltas)
+        jitter = np.bincount(keys[valid], deltas[valid], groups) / np.bincount(keys[valid], minlength=groups)
+
+    return {
+        "key": labels, "pings": count, "lost %": loss, "mean": mean, "std": std, "min": at(0.0),
+        **{f"p{p}": at(p / 100.0) for p in PERCENTILES}, "max": at(1.0), "jitter": jitter,
+    }
+
+
+def analyze(columns, file_names):
+    """
+    Return the summary rows per region, per hour of the day and per file.
+    """
+    hours, hour_keys = np.unique((columns["send_us"] // 3600000000) % 24, return_inverse=True)
+    groupings = [
+        ("region", columns["region"], columns["region_names"]),
+        ("hour", hour_keys.reshape(-1), [f"{hour:02d}:00" for hour in hours]),
+        ("file", columns["file"], [os.path.basename(file_name) for file_name in file_names]),
+    ]
+    rows = []
+    for by, keys, labels in groupings:
+        summary = summarize(np.asarray(keys, np.int64), labels, columns)
+        for i in range(len(labels)):
+            rows.append([by] + [summary[column][i] for column in COLUMNS[1:]])
+    return rows
+
+
+def format_table(rows):
+    def cell(value):
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (int, np.integer)):
+            return str(value)
+        return "-" if np.isnan(value) else f"{value:.2f}"
+
+    cells = [COLUMNS] + [[cell(value) for value in row] for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(COLUMNS))]
+    return "\n".join(
+        "  ".join(value.ljust(width) if i < 2 else value.rjust(width) for i, (value, width) in enumerate(zip(row, widths)))
+        for row in cells
+    )
+
+
+def find_logs(paths, pattern="ping_results_*"):
+    file_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            file_names.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            file_names.append(path)
+    return file_names
+
+
+def main(paths, pattern="ping_results_*", workers=None, csv_file=None):
+    file_names = find_logs(paths, pattern)
+    if not file_names:
+        print("No result files found.")
+        return
+    columns = load_corpus(file_names, workers)
+    rows = analyze(columns, file_names)
+    print(f"{len(columns['send_us'])} pings from {len(file_names)} files, "
+          f"loss only counted for files recorded in the binary format ({int(columns['known_loss'].sum())} pings)\n")
+    print(format_table(rows))
+    if csv_file is not None:
+        with open(csv_file, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(COLUMNS)
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize a directory of ping result files per region, hour and file')
+    parser.add_argument('paths', nargs='+', help='Directories with result files, or result files.')
+    parser.add_argument('-p', '--pattern', default='ping_results_*', help='File name pattern inside directories. Default is ping_results_*.')
+    parser.add_argument('-j', '--workers', type=int, help='Parser processes. Default is one per CPU, 1 parses in this process.')
+    parser.add_argument('--csv', help='Also write the summary table to this CSV file.')
+    args = parser.parse_args()
+    main(args.paths, args.pattern, args.workers, args.csv)
@@ -0,0 +1,756 @@
+import argparse
+import contextlib
+import ctypes
+import fcntl
+import gc
+import gzip
+import heapq
+import json
+import multiprocessing
+import os
+import platform
+import random
+import select
+import shutil
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from ping_core import (
+    BACKENDS, ICMP_HEADER, IcmpProber, LowJitter, PacketTemplate, SampleFanout, SampleStore, clock_anchor, create_packet,
+    find_best_region, ping_server, probe_concurrently,
+)
+from ping_dashboard import Dashboard
+import ping_logs
+from ping_logs import LOG_WRITERS, TextLogWriter, WriterProcess
+from ping_stats import StageProfile
+
+BENCHMARKS = ["packets", "logs", "startup", "filter", "lowjitter", "sinks", "echo", "select"]
+
+# Metrics compared against a baseline, by the direction that counts as a regression
+LOWER_IS_BETTER = {"ns_per_packet", "wakeups_per_ping", "foreign_wakeups_per_ping", "cpu_us_per_probe", "peak_bytes_per_ping",
+                   "added_rtt_median_us", "added_rtt_p99_us", "seconds_per_choice",
+                   "pings_per_choice", "import_ms", "startup_ms", "p999_us"}
+HIGHER_IS_BETTER = {"max_rate", "correct_percent"}
+
+# Entry points whose import time the startup benchmark guards, and modules they must not load
+# before they are needed: uploads and the results file readers import them on first use
+ENTRY_POINTS = ["ping_collector", "ping_collector_test_all", "ping_daemon"]
+LAZY_MODULES = ["http.client", "ssl", "numpy", "zstandard", "ping_upload"]
+
+# Linux constants for isolate_network(), the standard library does not export them
+CLONE_NEWNET = 0x40000000
+SIOCSIFFLAGS = 0x8914
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_RUNNING = 0x40
+
+
+def time_per_call(function, argument_count, repeat=5):
+    """
+    Return the best time of a call over repeat rounds in nanoseconds, with the garbage collector off.
+    The function is called with every integer below argument_count.
+    """
+    arguments = range(argument_count)
+    best = None
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            for argument in arguments:
+                function(argument)
+            elapsed = (time.perf_counter_ns() - start) / argument_count
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+
+def peak_bytes_per_call(function, argument=4242):
+    """
+    Return the most memory a single call has allocated at once, as seen by tracemalloc.
+    """
+    function(argument)  # Warm up caches first
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        function(argument)
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)] if ordered else float("nan")
+
+
+def verify_packets(ids, size=59):
+    """
+    Compare PacketTemplate with create_packet() for every sequence number of every id.
+    Return the number of packets compared and the (id, sequence) pairs that differ.
+    """
+    compared = 0
+    mismatches = []
+    for id in ids:
+        template = PacketTemplate(id, size)
+        for sequence in range(1 << 16):
+            if template.patch(sequence) != create_packet(id, size, sequence):
+                mismatches.append((id, sequence))
+            compared += 1
+    return compared, mismatches
+
+
+def bench_packets(ids=8, count=100000, seed=None):
+    rng = random.Random(seed)
+    identifiers = [0, 0xffff] + [rng.getrandbits(16) for _ in range(max(ids - 2, 0))]
+    compared, mismatches = verify_packets(identifiers)
+    print(f"Packets compared with create_packet(): {compared} ({len(identifiers)} ids x every sequence), "
+          f"{len(mismatches)} differ")
+    for id, sequence in mismatches[:10]:
+        print(f"  id {id:#06x} sequence {sequence}")
+
+    template = PacketTemplate(identifiers[-1])
+    build = lambda sequence: create_packet(template.id, sequence=sequence & 0xffff)
+    patch = lambda sequence: template.patch(sequence & 0xffff)
+    results = {"ok": not mismatches, "compared": compared, "mismatches": len(mismatches)}
+    print(f"{'':<20}{'ns/packet':>12}{'peak bytes':>12}")
+    for name, function in (("create_packet", build), ("PacketTemplate", patch)):
+        results[name] = {"ns_per_packet": time_per_call(function, count), "peak_bytes": peak_bytes_per_call(function)}
+        print(f"{name:<20}{results[name]['ns_per_packet']:>12.0f}{results[name]['peak_bytes']:>12}")
+    return results
+
+
+def bench_logs(pings=100000, seed=None):
+    """
+    Write a run with lost pings in every format, gzip a copy of each like the daemon does with its
+    closed segments, and check that ping_logs.read_log() returns the same samples for the plain and
+    the gzipped file. Time the reads per ping.
+    """
+    rng = random.Random(seed)
+    anchor = clock_anchor()
+    start = anchor[1]
+    samples = []
+    for seq in range(pings):
+        lost = rng.random() < 0.01
+        samples.append((seq, start + seq * 10000000, -1 if lost else rng.randrange(5000000, 50000000),
+                        ping_logs.LOST if lost else ping_logs.OK, ping_logs.USER))
+    results = {"ok": True, "pings": pings}
+    print(f"{pings} pings per results file, read back plain and gzipped")
+    print(f"{'file':<14}{'ns/ping':>10}{'same':>6}")
+    with tempfile.TemporaryDirectory() as directory:
+        for log_format, writer_class in LOG_WRITERS.items():
+            file_name = os.path.join(directory, f"ping_results_R_{log_format}{writer_class.extension}")
+            with writer_class(file_name, anchor, flush_interval=None) as writer:
+                writer.begin_region("R", ["Backend: raw"])
+                for sample in samples:
+                    writer.append(*sample)
+            with open(file_name, 'rb') as source, gzip.open(f"{file_name}.gz", 'wb') as destination:
+                shutil.copyfileobj(source, destination)
+            plain = None
+            for name in (file_name, f"{file_name}.gz"):
+                start_ns = time.perf_counter_ns()
+                log = ping_logs.read_log(name)
+                read = [list(region.samples()) for region in log]
+                elapsed = (time.perf_counter_ns() - start_ns) / pings
+                plain = read if plain is None else plain
+                same = read == plain and log.format == log_format
+                label = f"{log_format}{'.gz' if name.endswith('.gz') else ''}"
+                results[label] = {"ns_per_ping": elapsed, "same": same}
+                results["ok"] &= same
+                print(f"{label:<14}{elapsed:>10.0f}{'yes' if same else 'NO':>6}")
+    return results
+
+
+def import_profile(module):
+    """
+    Import module in a fresh interpreter with -X importtime and return its cumulative import time
+    in microseconds and the names of all modules the import loaded.
+    """
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)  # Cached bytecode, like every start after the first
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+    total_us = None
+    loaded = set()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        loaded.add(name.strip())
+        if name.strip() == module and not name[1:].startswith(" "):
+            total_us = int(cumulative)
+    return total_us, loaded
+
+
+def bench_startup(repeat=7, budget_ms=50):
+    """
+    Time the import of every entry point in fresh interpreters, the part of a cold start the
+    collector controls, and check it stays within budget_ms and leaves the LAZY_MODULES unloaded.
+    Also time a whole interpreter start that imports it, against one that imports nothing.
+    """
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    def startup_ms(code):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], env=env, cwd=directory, check=True)
+            elapsed = (time.perf_counter() - start) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    bare_ms = startup_ms("pass")
+    results = {"ok": True, "budget_ms": budget_ms, "bare_startup_ms": bare_ms}
+    print(f"Import of every entry point, best of {repeat} fresh interpreters, budget {budget_ms:g} ms "
+          f"(an interpreter that imports nothing starts in {bare_ms:.1f} ms)")
+    print(f"{'entry point':<26}{'import ms':>10}{'startup ms':>12}  eagerly loaded")
+    for module in ENTRY_POINTS:
+        import_profile(module)  # Writes the bytecode caches
+        import_us = min(import_profile(module)[0] for _ in range(repeat))
+        eager = [name for name in LAZY_MODULES if name in import_profile(module)[1]]
+        row = results[module] = {"import_ms": import_us / 1000, "startup_ms": startup_ms(f"import {module}"),
+                                 "eager": eager}
+        results["ok"] &= row["import_ms"] <= budget_ms and not eager
+        print(f"{module:<26}{row['import_ms']:>10.1f}{row['startup_ms']:>12.1f}  {', '.join(eager) or '-'}")
+    return results
+
+
+def send_foreign_traffic(host, rate, stop):
+    """
+    Send echo requests with another identifier to host at rate per second until stop is set.
+    On loopback every request and its reply reach every raw ICMP socket of the machine.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp"))
+    template = PacketTemplate(random.getrandbits(16))
+    burst = 10
+    sequence = 0
+    try:
+        while not stop.is_set():
+            for _ in range(burst):
+                sequence += 1
+                sock.sendto(template.patch(sequence & 0xffff), (host, 1))
+            stop.wait(burst / rate)
+    finally:
+        sock.close()
+
+
+def raw_sockets_allowed():
+    try:
+        with IcmpProber(backend="raw"):
+            return True
+    except PermissionError:
+        return False
+
+
+def ping_wakeups(socket_filter, pings, host):
+    """
+    Ping host over a raw socket and return whether the filter got attached, the wakeups per ping
+    and the median round trip time in microseconds.
+    """
+    with IcmpProber(backend="raw", socket_filter=socket_filter) as prober:
+        rtts = []
+        for _ in range(pings):
+            result = prober.ping(host)
+            if result is not None:
+                rtts.append((result[1] - result[0]) / 1000)
+        return prober.filtered, prober.wakeups / pings, statistics.median(rtts) if rtts else float("nan")
+
+
+def bench_filter(pings=500, foreign_rate=5000, host="127.0.0.1"):
+    """
+    Ping host over a raw socket with and without the BPF filter, first on a quiet machine and
+    then while other ICMP traffic reaches it. Even a quiet raw socket wakes up for its own looped
+    back echo requests, so the wakeups the foreign traffic causes are the difference between the
+    two runs of a mode. The filter passes when the unfiltered socket woke up at least 10 times for
+    foreign packets and the filter removed at least 90% of those wakeups.
+    """
+    if not raw_sockets_allowed():
+        print("The filter benchmark needs a raw ICMP socket, run it as root.")
+        return {"ok": True, "skipped": True}
+    print(f"{pings} pings to {host}, quiet and with {foreign_rate} foreign echo requests per second")
+    print(f"{'':<12}{'filtered':>10}{'quiet':>8}{'noisy':>8}{'foreign':>9}{'median us':>11}  wakeups per ping")
+    results = {}
+    for socket_filter in (False, True):
+        name = "bpf" if socket_filter else "unfiltered"
+        filtered, quiet, _ = ping_wakeups(socket_filter, pings, host)
+        # A process of its own, so the noise does not compete with the probe loop for the GIL
+        context = multiprocessing.get_context("fork")
+        stop = context.Event()
+        noise = context.Process(target=send_foreign_traffic, args=(host, foreign_rate, stop), daemon=True)
+        noise.start()
+        try:
+            time.sleep(0.2)
+            filtered, noisy, median = ping_wakeups(socket_filter, pings, host)
+        finally:
+            stop.set()
+            noise.join()
+        results[name] = {"filtered": filtered, "quiet_wakeups_per_ping": quiet, "wakeups_per_ping": noisy,
+                         "foreign_wakeups_per_ping": max(noisy - quiet, 0.0), "median_us": median}
+        print(f"{name:<12}{str(filtered):>10}{quiet:>8.2f}{noisy:>8.2f}{results[name]['foreign_wakeups_per_ping']:>9.2f}{median:>11.1f}")
+    foreign = results["unfiltered"]["foreign_wakeups_per_ping"]
+    if foreign * pings < 10:
+        print("The foreign traffic barely reached the unfiltered socket, so the filter was not put to the test.")
+    results["ok"] = foreign * pings >= 10 and results["bpf"]["foreign_wakeups_per_ping"] <= 0.1 * foreign
+    return results
+
+
+def bench_low_jitter(duration=5, rate=1000, busy_poll=0, realtime=False, host="127.0.0.1"):
+    """
+    Ping the kernel's loopback echo at a fixed rate in the normal and in the low jitter mode,
+    writing the samples to a results file like a real run does, and compare the tails.
+    """
+    results = {"ok": True, "rate": rate, "duration": duration, "busy_poll_us": busy_poll}
+    print(f"{duration:g} seconds of {rate:g} pings per second to {host} in every mode, busy poll {busy_poll} us")
+    print(f"{'mode':<12}{'pings':>8}{'p50 us':>9}{'p99 us':>9}{'p99.9 us':>10}{'max us':>10}")
+    with tempfile.TemporaryDirectory() as directory, WriterProcess() as writer_process:
+        for mode in ("normal", "low_jitter"):
+            low = mode == "low_jitter"
+            store = SampleStore()
+            with IcmpProber(busy_poll=busy_poll if low else 0) as prober, \
+                    writer_process.writer("text", os.path.join(directory, f"{mode}.txt"), store.anchor) as writer:
+                writer.begin_region(host)
+                with LowJitter(realtime=realtime) if low else contextlib.nullcontext() as low_jitter:
+                    ping_server(prober, host, rate=rate, duration=duration, sink=SampleFanout(store, writer))
+                writer.end_region()
+            rtts = sorted(rtt / 1000 for rtt in store.rtt_ns if rtt >= 0)
+            row = results[mode] = {
+                "pings": len(rtts), "p50_us": percentile(rtts, 50), "p99_us": percentile(rtts, 99),
+                "p999_us": percentile(rtts, 99.9), "max_us": rtts[-1] if rtts else float("nan"),
+            }
+            if low:
+                row["applied"] = low_jitter.applied
+            print(f"{mode:<12}{row['pings']:>8}{row['p50_us']:>9.1f}{row['p99_us']:>9.1f}{row['p999_us']:>10.1f}{row['max_us']:>10.1f}")
+    normal, low = results["normal"]["p999_us"], results["low_jitter"]["p999_us"]
+    results["p999_change_percent"] = 100.0 * (low - normal) / normal
+    print(f"p99.9 {normal:.1f} us -> {low:.1f} us ({results['p999_change_percent']:+.0f}%) with "
+          f"{', '.join(results['low_jitter']['applied'])}")
+    return results
+
+
+def bench_sinks(duration=8, rate=300, targets=7, rounds=3):
+    """
+    Ping targets loopback addresses at rate pings per second each, like ping_collector_test_all
+    pings the regions, with only a SampleStore as sink ("store"), with a TextLogWriter in the probe
+    loop as well ("writer"), with a BackgroundWriter of a WriterProcess ("background") and with an
+    interactive Dashboard, drawing into os.devnull, on top of that ("dashboard"), and compare the
+    round trip time tails. The modes take turns for rounds rounds, so a noisy moment of
+    the machine does not land on one mode only, and the medians of the rounds are reported.
+    """
+    hosts = {f"target {i}": f"127.0.0.{i + 1}" for i in range(targets)}
+    modes = ["store", "writer", "background", "dashboard"]
+    results = {"rate": rate, "duration": duration, "targets": targets, "rounds": rounds}
+    rows = {mode: [] for mode in modes}
+    print(f"{rounds} rounds of {duration:g} seconds of {rate:g} pings per second to each of {targets} loopback addresses")
+    with tempfile.TemporaryDirectory() as directory, WriterProcess() as writer_process:
+        for round_index in range(rounds):
+            for mode in modes:
+                anchor = clock_anchor()
+                stores = {name: SampleStore(anchor) for name in hosts}
+                writers = {}
+                for name in hosts:
+                    file_name = os.path.join(directory, f"{mode}_{round_index}_{name}.txt")
+                    if mode == "writer":
+                        writers[name] = TextLogWriter(file_name, anchor)
+                    elif mode in ("background", "dashboard"):
+                        writers[name] = writer_process.writer("text", file_name, anchor)
+                    else:
+                        continue
+                    writers[name].begin_region(name)
+                dashboard = Dashboard(hosts, output=os.devnull, interactive=True) if mode == "dashboard" else None
+                sinks = {name: SampleFanout(stores[name], writers[name], *[dashboard.ring(name)] if dashboard else [])
+                         if writers else stores[name] for name in hosts}
+                with IcmpProber() as prober, dashboard or contextlib.nullcontext():
+                    _, reports = probe_concurrently(prober, hosts, rate=rate, duration=duration, sinks=sinks)
+                for writer in writers.values():
+                    writer.close()
+                rtts = [rtt / 1000 for store in stores.values() for rtt in store.rtt_ns if rtt >= 0]
+                rows[mode].append({
+                    "pings": len(rtts), "p999_us": percentile(rtts, 99.9), "max_us": max(rtts, default=float("nan")),
+                    "over_1ms": sum(rtt > 1000 for rtt in rtts),
+                    "rate": sum(report.sent for report in reports.values()) / duration,
+                })
+    print(f"{'mode':<12}{'pings/s':>9}{'p99.9 us':>10}{'max us':>10}{'over 1 ms':>11}")
+    for mode in modes:
+        row = results[mode] = {key: statistics.median(round_row[key] for round_row in rows[mode])
+                               for key in ("rate", "p999_us", "max_us", "over_1ms")}
+        print(f"{mode:<12}{row['rate']:>9.0f}{row['p999_us']:>10.1f}{row['max_us']:>10.1f}{row['over_1ms']:>11.0f}")
+    store, background, dashboard = (results[mode]["p999_us"] for mode in ("store", "background", "dashboard"))
+    # Loopback tails are noisy, the checks are for stalls of the probe loop, not for a few percent
+    results["ok"] = True
+    if background > 2 * store + 1000:
+        results["ok"] = False
+        print(f"The background writer raised p99.9 from {store:.0f} us to {background:.0f} us.")
+    if dashboard > 2 * background + 1000:
+        results["ok"] = False
+        print(f"The dashboard raised p99.9 from {background:.0f} us to {dashboard:.0f} us.")
+    return results
+
+
+def isolate_network():
+    """
+    Move this process into a new network namespace (Linux, root) with only loopback up and the
+    kernel's own echo replies switched off, so an EchoResponder is the only thing that answers
+    pings. Unprivileged ping sockets are allowed for every group inside it.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.unshare(CLONE_NEWNET) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, f"Could not create a network namespace: {os.strerror(error)}")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        fcntl.ioctl(sock, SIOCSIFFLAGS, struct.pack("16sH14x", b"lo", IFF_UP | IFF_LOOPBACK | IFF_RUNNING))
+    with open("/proc/sys/net/ipv4/icmp_echo_ignore_all", "w") as file:
+        file.write("1")
+    with open("/proc/sys/net/ipv4/ping_group_range", "w") as file:
+        file.write("0 2147483647")
+
+
+class EchoResponder:
+    """
+    User-space stand-in for a ping server: a separate process with a raw ICMP socket that answers
+    every echo request after delay_ms, plus or minus up to jitter_ms, and drops a share loss of
+    them. delays maps loopback addresses such as "127.0.0.2" to their own delay_ms, so every
+    address can stand in for a region. It remembers how long it actually held every reply, by (id, seq), which is the ground
+    truth the measured round trip times are compared with. Run it inside isolate_network(), or
+    the kernel answers the pings as well.
+    """
+
+    def __init__(self, delay_ms=0, jitter_ms=0, loss=0, seed=None, delays=None):
+        self.delay_ms = delay_ms
+        self.delays = {socket.inet_aton(address): delay for address, delay in (delays or {}).items()}
+        self.jitter_ms = jitter_ms
+        self.loss = loss
+        self.seed = seed
+        self.process = None
+        self.connection = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        context = multiprocessing.get_context("fork")  # The child has to share the network namespace
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=self._serve, args=(child,), daemon=True)
+        self.process.start()
+        self.connection.recv()  # Wait until the socket is open
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.connection.send("stop")
+            self.process.join()
+            self.process = None
+
+    def holds(self):
+        """
+        Return the hold time in nanoseconds of every reply sent since the last call, by (id, seq).
+        """
+        self.connection.send("holds")
+        return self.connection.recv()
+
+    def _serve(self, connection):
+        rng = random.Random(self.seed)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp"))
+        buffer = bytearray(2048)
+        pending = []  # Heap of (due_ns, counter, reply, address, received_ns, key)
+        holds = {}
+        counter = 0
+        connection.send("ready")
+        while True:
+            timeout = max(pending[0][0] - time.perf_counter_ns(), 0) / 1e9 if pending else None
+            ready = select.select([sock, connection], [], [], timeout)[0]
+            if connection in ready:
+                command = connection.recv()
+                if command == "stop":
+                    break
+                connection.send(holds)
+                holds = {}
+            if sock in ready:
+                length, address = sock.recvfrom_into(buffer)
+                received_ns = time.perf_counter_ns()
+                offset = (buffer[0] & 0x0f) * 4
+                if length >= offset + ICMP_HEADER.size and buffer[offset] == 8 and rng.random() >= self.loss:
+                    reply = bytearray(buffer[offset:length])
+                    type, code, checksum, id, sequence = ICMP_HEADER.unpack_from(reply)
+                    # Only the type changes from 8 to 0, so the checksum changes by the same amount (RFC 1624)
+                    old_word, = struct.unpack_from("H", reply)
+                    reply[0] = 0
+                    new_word, = struct.unpack_from("H", reply)
+                    total = (~checksum & 0xffff) + (~old_word & 0xffff) + new_word
+                    total = (total & 0xffff) + (total >> 16)
+                    total = (total & 0xffff) + (total >> 16)
+                    struct.pack_into("H", reply, 2, ~total & 0xffff)
+                    delay_ms = self.delays.get(bytes(buffer[16:20]), self.delay_ms)
+                    delay_ms = max(delay_ms + rng.uniform(-self.jitter_ms, self.jitter_ms), 0)
+                    counter += 1
+                    heapq.heappush(pending, (received_ns + int(delay_ms * 1e6), counter, reply, address,
+                                             received_ns, (id, sequence)))
+            while pending and pending[0][0] <= time.perf_counter_ns():
+                _, _, reply, address, received_ns, key = heapq.heappop(pending)
+                sock.sendto(reply, address)
+                holds[key] = time.perf_counter_ns() - received_ns
+        sock.close()
+
+
+def profile_cost_ns(profile, packets_per_ping):
+    """
+    Return the time a StageProfile adds to a ping on average: a clock read and a histogram update
+    for both stages of the send path, for both stages of every packet read, and for the wakeup of
+    the reply, in one out of profile.every of them. Timing these directly is steadier than
+    comparing whole runs, whose noise is far above 1%.
+    """
+    counts = [0] * StageProfile.BUCKETS
+    clock = time.perf_counter_ns
+
+    def timed_stage(start):
+        counts[(clock() - start).bit_length()] += 1
+
+    stage_ns = time_per_call(timed_stage, 100000)
+    return (2 + 2 * packets_per_ping + 1) * stage_ns / profile.every
+
+
+def max_probe_rate(prober, host, loss=0, duration=0.5, start_rate=1000, limit=128000):
+    """
+    Double the fixed probe rate until the replies start getting lost or the achieved rate stops
+    growing, and return the highest achieved rate in pings per second.
+    """
+    best = 0
+    rate = start_rate
+    while rate <= limit:
+        results, reports = probe_concurrently(prober, {host: host}, rate=rate, duration=duration)
+        report = reports[host]
+        if not report.sent or report.received < (1 - loss - 0.02) * report.sent:
+            break
+        achieved = report.sent / report.duration
+        saturated = achieved < 1.1 * best  # A higher rate would only skip more slots
+        best = max(best, achieved)
+        if saturated:
+            break
+        rate *= 2
+    return best
+
+
+def bench_echo(pings=2000, delay_ms=0, jitter_ms=0, loss=0, kernel_timestamps=False, seed=None, host="127.0.0.1"):
+    """
+    Measure every prober backend against an EchoResponder in a private network namespace: the
+    highest probe rate it sustains, the CPU time and the peak memory of a probe, the round trip
+    time it adds on top of the responder's hold time, and the extra CPU time of a StageProfile.
+    """
+    if not raw_sockets_allowed():
+        print("The echo benchmark needs root for its network namespace and raw sockets.")
+        return {"ok": True, "skipped": True}
+    isolate_network()
+    results = {"ok": True, "delay_ms": delay_ms, "jitter_ms": jitter_ms, "loss": loss}
+    print(f"Local echo stand-in, delay {delay_ms} ms, jitter {jitter_ms} ms, loss {100 * loss:g}%, "
+          f"kernel timestamps {'on' if kernel_timestamps else 'off'}")
+    print(f"{'backend':<10}{'max rate':>10}{'cpu us':>9}{'peak B':>8}{'added median us':>17}{'added p99 us':>14}"
+          f"{'profiling':>11}")
+    with EchoResponder(delay_ms, jitter_ms, loss, seed) as responder:
+        for backend in BACKENDS:
+            with IcmpProber(timeout=max(1, 4 * (delay_ms + jitter_ms) / 1000), kernel_timestamps=kernel_timestamps,
+                            backend=backend) as prober:
+                prober.ping(host)  # Warm up
+                responder.holds()
+                rtts = {}
+                cpu_start = time.process_time_ns()
+                for _ in range(pings):
+                    result = prober.ping(host)
+                    if result is not None:
+                        rtts[prober.sequence & 0xffff] = result[1] - result[0]
+                cpu_ns = time.process_time_ns() - cpu_start
+                holds = responder.holds()
+                # The same pings with the stage histograms on, for their breakdown and cost
+                profile = prober.profile = StageProfile()
+                wakeups = prober.wakeups
+                for _ in range(pings):
+                    prober.ping(host)
+                prober.profile = None
+                profile_ns = profile_cost_ns(profile, (prober.wakeups - wakeups) / pings)
+                added = [(rtt - holds[(prober.identifier, sequence)]) / 1000 for sequence, rtt in rtts.items()
+                         if (prober.identifier, sequence) in holds]
+                peak = peak_bytes_per_call(lambda _: prober.ping(host))
+                rate = max_probe_rate(prober, host, loss)
+            results[backend] = {
+                "max_rate": rate,
+                "cpu_us_per_probe": cpu_ns / pings / 1000,
+                "peak_bytes_per_ping": peak,
+                "added_rtt_median_us": statistics.median(added) if added else float("nan"),
+                "added_rtt_p99_us": percentile(added, 99),
+                "received": len(rtts),
+                "profile_overhead_percent": 100.0 * profile_ns / (cpu_ns / pings),
+                "stage_p50_ns": {stage: StageProfile.quantile(counts, 0.5) for stage, counts in profile.histograms().items()},
+            }
+            row = results[backend]
+            print(f"{backend:<10}{row['max_rate']:>10.0f}{row['cpu_us_per_probe']:>9.1f}{row['peak_bytes_per_ping']:>8}"
+                  f"{row['added_rtt_median_us']:>17.1f}{row['added_rtt_p99_us']:>14.1f}{row['profile_overhead_percent']:>+10.1f}%")
+    return results
+
+
+class StaticResolver:
+    """
+    Stand-in for ResolverCache with fixed addresses, for regions played by loopback addresses.
+    """
+
+    def __init__(self, addresses):
+        self.regions = addresses
+        self.addresses = addresses
+
+    def get(self, region):
+        return self.addresses.get(region)
+
+    def target(self, region):
+        return self.addresses[region]
+
+
+def mean_selection(prober, resolver, sample_size=10):
+    """
+    The region selection before find_best_region() went adaptive: sample_size pings to every region,
+    one in flight each, and the lowest mean wins. Kept to compare against.
+    """
+    results, _ = probe_concurrently(prober, {region: resolver.target(region) for region in resolver.regions}, sample_size)
+    means = {region: statistics.mean(store.rtts_ms()) for region, store in results.items() if store.rtts_ms()}
+    return min(means, key=means.get, default=None)
+
+
+def bench_select(trials=20, jitter_ms=5, loss=0, seed=None):
+    """
+    Choose the best of seven regions, played by loopback addresses an EchoResponder answers with
+    different delays (two of them close), over and over with both the old and the adaptive
+    selection: how long a choice takes, how many pings it sends, how often it picks the region with
+    the lowest delay and how often it changes its mind from one choice to the next.
+    """
+    if not raw_sockets_allowed():
+        print("The select benchmark needs root for its network namespace and raw sockets.")
+        return {"ok": True, "skipped": True}
+    isolate_network()
+    delays = {"NA-East": 30, "NA-Central": 31, "NA-West": 70, "Europe": 110, "Brazil": 140, "Oceania": 200, "Asia": 250}
+    addresses = {region: f"127.0.0.{i + 2}" for i, region in enumerate(delays)}
+    resolver = StaticResolver(addresses)
+    best = min(delays, key=delays.get)
+    results = {"ok": True, "jitter_ms": jitter_ms, "loss": loss}
+    print(f"{trials} region choices between delays of {', '.join(f'{d} ms' for d in delays.values())}, "
+          f"jitter {jitter_ms} ms, loss {100 * loss:g}%")
+    print(f"{'selection':<12}{'seconds':>9}{'pings':>7}{'correct':>9}{'switches':>10}")
+    selections = {
+        "mean": lambda prober, previous: mean_selection(prober, resolver),
+        "adaptive": lambda prober, previous: find_best_region(prober, resolver, 30, {}, incumbent=previous),
+    }
+    with EchoResponder(jitter_ms=jitter_ms, loss=loss, seed=seed,
+                       delays={addresses[region]: delay for region, delay in delays.items()}):
+        for name, select_region in selections.items():
+            with IcmpProber() as prober, contextlib.redirect_stdout(None):
+                chosen = []
+                elapsed = 0
+                start_sequence = prober.sequence
+                for _ in range(trials):
+                    start = time.perf_counter()
+                    chosen.append(select_region(prober, chosen[-1] if chosen else None))
+                    elapsed += time.perf_counter() - start
+                pings = prober.sequence - start_sequence
+            row = results[name] = {
+                "seconds_per_choice": elapsed / trials,
+                "pings_per_choice": pings / trials,
+                "correct_percent": 100.0 * chosen.count(best) / trials,
+                "switches": sum(a != b for a, b in zip(chosen, chosen[1:])),
+            }
+            print(f"{name:<12}{row['seconds_per_choice']:>9.2f}{row['pings_per_choice']:>7.0f}"
+                  f"{row['correct_percent']:>8.0f}%{row['switches']:>10}")
+    results["ok"] = results["adaptive"]["correct_percent"] >= results["mean"]["correct_percent"]
+    return results
+
+
+def compare(results, baseline, tolerance, path=""):
+    """
+    Return a line for every metric that got worse than in baseline by more than tolerance (0.2 is 20%).
+    """
+    regressions = []
+    for key, value in results.items():
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict):
+            regressions += compare(value, old, tolerance, f"{path}{key}.")
+        elif isinstance(old, (int, float)) and old > 0 and isinstance(value, (int, float)):
+            if key in LOWER_IS_BETTER and value > old * (1 + tolerance) or \
+                    key in HIGHER_IS_BETTER and value < old * (1 - tolerance):
+                regressions.append(f"{path}{key}: {old:.1f} -> {value:.1f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks of the collector hot path')
+    parser.add_argument('benchmarks', nargs='*', choices=BENCHMARKS, default=BENCHMARKS, help=f'Benchmarks to run. Default is all of {", ".join(BENCHMARKS)}.')
+    parser.add_argument('-i', '--ids', type=int, default=8, help='Identifiers to check every sequence number of, 0 and 0xffff included. Default is 8.')
+    parser.add_argument('-n', '--count', type=int, default=100000, help='Calls per timing round. Default is 100000.')
+    parser.add_argument('--seed', type=int, help='Random seed for the identifiers and the echo stand-in.')
+    parser.add_argument('--log-pings', type=int, default=100000, help='Pings in the results files of the logs benchmark. Default is 100000.')
+    parser.add_argument('--import-budget', type=float, default=50, help='Most milliseconds an entry point may take to import in the startup benchmark. Default is 50.')
+    parser.add_argument('-p', '--pings', type=int, default=500, help='Pings per mode of the filter benchmark. Default is 500.')
+    parser.add_argument('--foreign-rate', type=int, default=5000, help='Foreign echo requests per second during the filter benchmark. Default is 5000.')
+    parser.add_argument('--low-jitter-seconds', type=float, default=5, help='Seconds of pings per mode of the low jitter benchmark. Default is 5.')
+    parser.add_argument('--low-jitter-rate', type=float, default=1000, help='Pings per second of the low jitter benchmark. Default is 1000.')
+    parser.add_argument('--sink-seconds', type=float, default=8, help='Seconds of pings per mode and round of the sinks benchmark, long enough for full batches. Default is 8.')
+    parser.add_argument('--sink-rate', type=float, default=300, help='Pings per second to each address of the sinks benchmark. Default is 300.')
+    parser.add_argument('--busy-poll', type=int, default=0, help='Busy poll microseconds in the low jitter mode. Default is 0.')
+    parser.add_argument('--realtime', action='store_true', help='Ask for SCHED_FIFO in the low jitter mode.')
+    parser.add_argument('--echo-pings', type=int, default=2000, help='Pings per backend against the echo stand-in. Default is 2000.')
+    parser.add_argument('--trials', type=int, default=20, help='Region choices per selection of the select benchmark. Default is 20.')
+    parser.add_argument('--select-jitter', type=float, default=5, help='Random extra or shorter reply delay of the regions of the select benchmark, up to this many ms. Default is 5.')
+    parser.add_argument('--delay', type=float, default=0, help='Reply delay of the echo stand-in in ms. Default is 0.')
+    parser.add_argument('--jitter', type=float, default=0, help='Random extra or shorter reply delay of the echo stand-in, up to this many ms. Default is 0.')
+    parser.add_argument('--loss', type=float, default=0, help='Share of echo requests the stand-in drops, 0.01 is 1%%. Default is 0.')
+    parser.add_argument('-k', '--kernel-timestamps', action='store_true', help='Let the kernel timestamp the pings of the echo benchmark.')
+    parser.add_argument('--json', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='JSON results of an earlier run; fail when a metric got worse by more than the tolerance.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against --compare, 0.2 is 20%%. Default is 0.2.')
+    args = parser.parse_args()
+
+    results = {"python": platform.python_version(), "platform": platform.platform(), "benchmarks": {}}
+    benchmarks = results["benchmarks"]
+    # The echo and select benchmarks move the process into its own network namespace, so they run last
+    if "packets" in args.benchmarks:
+        benchmarks["packets"] = bench_packets(args.ids, args.count, args.seed)
+    if "logs" in args.benchmarks:
+        print()
+        benchmarks["logs"] = bench_logs(args.log_pings, args.seed)
+    if "startup" in args.benchmarks:
+        print()
+        benchmarks["startup"] = bench_startup(budget_ms=args.import_budget)
+    if "filter" in args.benchmarks:
+        print()
+        benchmarks["filter"] = bench_filter(args.pings, args.foreign_rate)
+    if "lowjitter" in args.benchmarks:
+        print()
+        benchmarks["lowjitter"] = bench_low_jitter(args.low_jitter_seconds, args.low_jitter_rate, args.busy_poll, args.realtime)
+    if "sinks" in args.benchmarks:
+        print()
+        benchmarks["sinks"] = bench_sinks(args.sink_seconds, args.sink_rate)
+    if "echo" in args.benchmarks:
+        print()
+        benchmarks["echo"] = bench_echo(args.echo_pings, args.delay, args.jitter, args.loss, args.kernel_timestamps, args.seed)
+    if "select" in args.benchmarks:
+        print()
+        benchmarks["select"] = bench_select(args.trials, args.select_jitter, args.loss, args.seed)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    passed = all(benchmark["ok"] for benchmark in benchmarks.values())
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            regressions = compare(results["benchmarks"], json.load(file)["benchmarks"], args.tolerance)
+        print(f"\n{len(regressions)} regressions against {args.compare}")
+        for regression in regressions:
+            print(f"  {regression}")
+        passed &= not regressions
+    sys.exit(0 if passed else 1)
@@ -1,239 +1,125 @@
-import socket
-import struct
-import select
-import http.client
-import json
 from datetime import datetime, timedelta
-import statistics
-import os
-import time
-
-def print_stats(data):
-    # Convert the ping results to milliseconds
-    ping_times = [(received_time - sent_time).total_seconds() * 1000 for sent_time, received_time in data]
-    
-    # Calculate the statistics
-    max_ping = max(ping_times)
-    min_ping = min(ping_times)
-    avg_ping = statistics.mean(ping_times)
-    median_ping = statistics.median(ping_times)
-    std_dev_ping = statistics.stdev(ping_times)
-    q1 = statistics.quantiles(ping_times, n=4)[0]  # First quartile (25th percentile)
-    q3 = statistics.quantiles(ping_times, n=4)[2]  # Third quartile (75th percentile)
-    iqr = q3 - q1  # Interquartile Range
-    
-    # Print the statistics
-    print("\nPing Statistics for Main Test:")
-    print(f"  - Max Ping: {max_ping:.2f} milliseconds")
-    print(f"  - Min Ping: {min_ping:.2f} milliseconds")
-    print(f"  - Average Ping: {avg_ping:.2f} milliseconds")
-    print(f"  - Median Ping: {median_ping:.2f} milliseconds")
-    print(f"  - Standard Deviation: {std_dev_ping:.2f} milliseconds")
-    print(f"  - Interquartile Range: {iqr:.2f} milliseconds\n")
-
-
-def checksum(source_string):
-    """
-    Calculate the checksum of the input bytes.
-    """
-    sum = 0
-    max_count = (len(source_string) // 2) * 2
-    count = 0
-    while count < max_count:
-        val = source_string[count + 1]*256 + source_string[count]
-        sum = sum + val
-        sum = sum & 0xffffffff
-        count = count + 2
-
-    if max_count < len(source_string):
-        sum = sum + source_string[len(source_string) - 1]
-        sum = sum & 0xffffffff
-
-    sum = (sum >> 16) + (sum & 0xffff)
-    sum = sum + (sum >> 16)
-    answer = ~sum
-    answer = answer & 0xffff
-    answer = answer >> 8 | (answer << 8 & 0xff00)
-    return answer
-def send_file(file_path):
-    host = '0a6ejoevl3.execute-api.us-east-1.amazonaws.com'
-    endpoint = '/prod/ping'
-
-    # Read file contents
-    with open(file_path, 'r') as file:
-        file_content = file.read()
-
-    # Setup connection
-    connection = http.client.HTTPSConnection(host)
-
-    # Headers
-    headers = {'Content-type': 'application/text'}
-
-    # Send POST request
-    connection.request('POST', endpoint, body=file_content, headers=headers)
-
-    # Get the response
-    response = connection.getresponse()
-    response_data = response.read()
-    response_json = json.loads(response_data)
-
-    # Check the response
-    if response.status == 200:
-        if "joke" in response_json:
-            print("Data sent to Marius, Marius is happy")
-            print(response_json["joke"])
-        else:
-            print("Received a response without a joke.")
-    else:
-        print("That didn't work, Marius don't worry, Marius probably don't need more data")
-        
-def create_packet(id, size=59):
-    """
-    Create a new echo request packet based on the given "id" and with a payload of the given size.
-    """
-    header = struct.pack("bbHHh", 8, 0, 0, id, 1)
-    data = size * "Q"
-    my_checksum = checksum(header + data.encode('utf-8'))
-    header = struct.pack("bbHHh", 8, 0, socket.htons(my_checksum), id, 1)
-    return header + data.encode('utf-8')
-
-def ping(host):
-    """
-    Send a single ping to the given host and return the timestamps.
-    """
-    icmp = socket.getprotobyname("icmp")
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, icmp)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", 2, 0))  # Timeout of 2 seconds
-    except socket.error as e:
-        if e.errno == 1:
-            e.msg += " - Note that ICMP messages can only be sent from processes running as root."
-            raise socket.error(e.msg)
-    except Exception as e:
-        print("Exception: " + str(e))
-        return None
-
-    my_id = datetime.now().microsecond & 0xFFFF
-    packet = create_packet(my_id)
-    sent_time = datetime.now()
-    sock.sendto(packet, (host, 1))
-    
-    while True:
-        ready = select.select([sock], [], [], 2)
-        if ready[0] == []:
-            return None  # If timeout occurs, return None
-
-        time_received = datetime.now()
-        rec_packet, addr = sock.recvfrom(1024)
-        icmp_header = rec_packet[20:28]
-        type, code, checksum, packet_id, sequence = struct.unpack("bbHHh", icmp_header)
-        if packet_id == my_id:
-            return (sent_time, time_received)
-
-
-def ping_server(host, sample_size):
-    """
-    Ping the server and return timestamps for a given number of samples.
-    """
-    results = []
-    start_time = datetime.now()
-    for _ in range(sample_size):
-        result = ping(host)
-        if result:
-            results.append(result)
-    end_time = datetime.now()
-    duration = (end_time - start_time).total_seconds()
-    frequency = sample_size / duration if duration > 0 else 0
-    return results, frequency
-
-def find_best_region(regions, sample_size, all_results):
-    min_avg_ping = None
-    best_region = None
-    for region, host in regions.items():
-        print(f"Pinging {region}...")
-        results, frequency = ping_server(host, sample_size)
-        all_results[region] = results  # Store results for each region correctly
-        if results:
-            avg_ping = sum((r[1] - r[0]).total_seconds() for r in results) / len(results)
-            print(f"{region} average ping: {avg_ping:.3f} seconds, frequency: {frequency:.2f} pings/sec")
-            if min_avg_ping is None or avg_ping < min_avg_ping:
-                min_avg_ping = avg_ping
-                best_region = region
-    return best_region
-
-
-def save_results_to_file(all_results, file_name):
-    with open(file_name, 'w') as file:
-        for region, results in all_results.items():
-            file.write(f"Region: {region}\n")
-            for sent_time, received_time in results:
-                file.write(f"Sent: {sent_time}, Received: {received_time}\n")
-            file.write("\n")
+import contextlib
 
+import ping_registry
+from ping_core import (
+    REGIONS, IcmpProber, LowJitter, ResolverCache, SampleFanout, clock_anchor, find_best_region, ping_server,
+    print_stats, region_footer, region_header, send_file,
+)
+from ping_dashboard import Dashboard
+from ping_logs import LOG_WRITERS, WriterProcess
+from ping_registry import RunRegistry
+from ping_stats import PingStats, StageProfile
 
 
 def main():
-    regions = {
-        "NA-East": "ping-nae.ds.on.epicgames.com",
-        "NA-Central": "ping-nac.ds.on.epicgames.com",
-        "NA-West": "ping-naw.ds.on.epicgames.com",
-        "Europe": "ping-eu.ds.on.epicgames.com",
-        "Oceania": "ping-oce.ds.on.epicgames.com",
-        "Brazil": "ping-br.ds.on.epicgames.com",
-        "Asia": "ping-asia.ds.on.epicgames.com"
-    }
-    sample_size = 10
+    regions = REGIONS
+    sample_size = 30  # Most pings per region while finding the best one, clearly worse regions stop earlier
     duration_minutes = 10  # Duration for the main check in minutes
-    slack_minutes = 4  # Slack time for network fluctuations
+    dns_ttl_seconds = 300  # How often the region addresses are re-resolved in the background
+    probe_rate = 0  # Pings per second on a fixed schedule for the main check, 0 waits for every reply before the next ping
+    kernel_timestamps = False  # Let the kernel timestamp pings where the platform supports it
+    backend = "auto"  # ICMP socket: "dgram" (no root needed on Linux), "raw", or "auto" to try them in that order
+    profile_hot_path = False  # Time the stages of 1 in 32 pings of the main check and add the breakdown to the results file
+    low_jitter = False  # Pin the probe loop to a core and keep the garbage collector out of the main check
+    realtime = False  # With low_jitter, also ask for the SCHED_FIFO realtime scheduler where permitted
+    busy_poll_us = 0  # Spin this many microseconds on the socket before sleeping, for the tightest timestamps
+    socket_filter = False  # Let the kernel drop ICMP packets that are not our replies (raw sockets on Linux)
+    log_format = "text"  # "binary" writes compact records with lost pings kept, see ping_logs.py
     all_results = {}  # Dictionary to store all results
-    print("Finding lowest ping server...")
-    best_region = find_best_region(regions, sample_size, all_results)
-    if best_region is not None:
-        print("\nBest Region Analysis:")
-        print(f"  - The best region is {best_region} with the lowest average ping.")
-        _, frequency = ping_server(regions[best_region], sample_size)
-        print(f"  - Approximate frequency: {frequency:.2f} pings/sec\n")
-        
-        # Calculate approximate sample size for the desired duration
-        approx_sample_size = int(frequency * 60 * duration_minutes)
-        start_time = datetime.now()
-        estimated_end_time = start_time + timedelta(minutes=duration_minutes)
-        estimated_end_time_min = estimated_end_time - timedelta(minutes=slack_minutes)
-        estimated_end_time_max = estimated_end_time + timedelta(minutes=slack_minutes)
-        print(f"Pinging {best_region} for an approximate duration of {duration_minutes} minutes...")
-        print("Don't do anything, but if you want to cancel, you can with Ctrl+C")
-        print(f"  - Start time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"  - Estimated end time: Between {estimated_end_time_min.strftime('%Y-%m-%d %H:%M')} and {estimated_end_time_max.strftime('%Y-%m-%d %H:%M')}\n")
-        
-        results, _ = ping_server(regions[best_region], approx_sample_size)
-        all_results[best_region] = results  # Store the main check results
-        
-        # Check if any log file for the current hour already exists
-        current_hour = time.strftime("%H")
-        log_file_exists = any(
-            current_hour == file[22:24] and file.endswith('.txt') and 'ping_results' in file
-            for file in os.listdir()
-        )
+    with IcmpProber(kernel_timestamps=kernel_timestamps, backend=backend, socket_filter=socket_filter,
+                    busy_poll=busy_poll_us) as prober, ResolverCache(regions, dns_ttl_seconds) as resolver, RunRegistry() as registry, \
+            WriterProcess() as writer_process:
+        print("Finding lowest ping server...")
+        best_region = find_best_region(prober, resolver, sample_size, all_results)
+        if best_region is not None:
+            print("\nBest Region Analysis:")
+            print(f"  - The best region is {best_region} with the lowest median ping.\n")
+
+            # Check if a log file was already sent this hour
+            log_file_exists = registry.uploaded_in_hour(datetime.now())
+
+            # Results are streamed to the file while pinging, the other regions go first. A child process
+            # formats and writes them, so the probe loop never waits on the file
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            file_name = f"ping_results_{timestamp}{LOG_WRITERS[log_format].extension}"
+            anchor = clock_anchor()
+            writer = writer_process.writer(log_format, file_name, anchor)
+            # Selection pings only count as lost against the shortened selection timeout, so just
+            # the answered ones are written, here and at the start of the main check
+            for region, results in all_results.items():
+                if region != best_region:
+                    writer.begin_region(region, region_header(region, resolver, prober.backend.name))
+                    for sample in results.answered():
+                        writer.append(*sample)
+                    writer.end_region()
+            stats = PingStats()
+            writer.begin_region(best_region, region_header(best_region, resolver, prober.backend.name))
+
+            # The main check runs until a fixed deadline instead of an extrapolated number of pings
+            start_time = datetime.now()
+            end_time = start_time + timedelta(minutes=duration_minutes)
+            print(f"Pinging {best_region} for {duration_minutes} minutes...")
+            print("Don't do anything, but if you want to cancel, you can with Ctrl+C")
+            print(f"  - Start time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
+            print(f"  - End time: {end_time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+            registry.add_run(start_time, best_region, file_name, log_format)
+
+            report = None
+            prober.profile = StageProfile() if profile_hot_path else None
+            low_jitter_mode = LowJitter(realtime=realtime) if low_jitter else None
+            try:
+                # The dashboard draws from its own process, the probe loop only fills its ring buffer.
+                # Low jitter mode goes without it, as the dashboard still takes CPU time
+                dashboard = Dashboard([best_region]) if low_jitter_mode is None else None
+                with dashboard or contextlib.nullcontext(), low_jitter_mode or contextlib.nullcontext():
+                    sink = SampleFanout(stats, writer, *[dashboard.ring(best_region)] if dashboard else [])
+                    for sample in all_results[best_region].answered():
+                        sink.append(*sample)
+                    _, report = ping_server(prober, resolver.target(best_region), rate=probe_rate,
+                                            duration=duration_minutes * 60, sink=sink)
+            except KeyboardInterrupt:
+                print("\nCancelled, keeping the pings collected so far.")
+            writer.end_region(region_footer(best_region, resolver, prober.profile, low_jitter_mode))
+            writer.close(interrupted=report is None)
+            registry.finish_run(file_name, stats.sent, stats.count)
+
+            print(f"\nResults Summary:")
+            print(f"  - All results saved to {file_name}")
+            print(f"  - Best region: {best_region}")
+            print(f"  - Socket backend: {prober.backend.name}")
+            if low_jitter_mode is not None:
+                print(f"  - Low jitter mode: {', '.join(low_jitter_mode.applied)}")
+            if report is not None:
+                print(f"  - {report}")
+            for changed_at, _, old_address, new_address in resolver.changes_for(best_region):
+                print(f"  - Address of {best_region} changed at {changed_at.strftime('%H:%M:%S')}: {old_address} -> {new_address}")
+            print_stats(stats)  # Print statistics for the main check
+            if prober.profile is not None:
+                print("Hot path breakdown of the main check:")
+                print("\n".join(prober.profile.summary_lines()) + "\n")
+
+            if report is None:
+                registry.set_upload_status(file_name, ping_registry.CANCELLED)
+                print("The log file was not sent because the run was cancelled.")
+            elif log_file_exists:
+                registry.set_upload_status(file_name, ping_registry.SKIPPED)
+                print(f"Marius did not need this log file, because it was within the same hour.")
+                print("If you want another joke, wait until the next hour.")
+            else:
+                # The registry is the upload queue, so it also records which files were sent
+                from ping_upload import Uploader  # Only runs that upload load http.client and ssl
+                with Uploader(queue=registry) as uploader:
+                    sent = uploader.send_queued()
+                    if sent:
+                        print(f"Sent {sent} log files that earlier runs could not send.")
+                    send_file(file_name, uploader)
 
-        # Store the results in a file
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        file_name = f"ping_results_{timestamp}.txt"
-        save_results_to_file(all_results, file_name)  # Save all results
-        
-        print(f"\nResults Summary:")
-        print(f"  - All results saved to {file_name}")
-        print(f"  - Best region: {best_region}\n")
-        print_stats(results)  # Print statistics for the main check
-        
-        if log_file_exists:
-            print(f"Marius did not need this log file, because it was within the same hour.")
-            print("If you want another joke, wait until the next hour.")
         else:
-            send_file(file_name)
-
-    else:
-        print("\nError:")
-        print("  - Could not determine the best region due to ping failures.\n")
+            print("\nError:")
+            print("  - Could not determine the best region due to ping failures.\n")
 
 if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()  # The results file is written by a child process, also from the .exe
     main()
@@ -1,250 +1,119 @@
 import argparse
-import socket
-import struct
-import select
-import http.client
-import json
+import contextlib
 from datetime import datetime, timedelta
-import statistics
-import os
-import time
 
-def print_stats(data):
-    # Convert the ping results to milliseconds
-    ping_times = [(received_time - sent_time).total_seconds() * 1000 for sent_time, received_time in data]
-    # Calculate the statistics
-    max_ping = max(ping_times)
-    min_ping = min(ping_times)
-    avg_ping = statistics.mean(ping_times)
-    median_ping = statistics.median(ping_times)
-    std_dev_ping = statistics.stdev(ping_times)
-    q1 = statistics.quantiles(ping_times, n=4)[0]  # First quartile (25th percentile)
-    q3 = statistics.quantiles(ping_times, n=4)[2]  # Third quartile (75th percentile)
-    iqr = q3 - q1  # Interquartile Range
-    
-    # Print the statistics
-    print("\nPing Statistics:")
-    print(f"  - Max Ping: {max_ping:.2f} milliseconds")
-    print(f"  - Min Ping: {min_ping:.2f} milliseconds")
-    print(f"  - Average Ping: {avg_ping:.2f} milliseconds")
-    print(f"  - Median Ping: {median_ping:.2f} milliseconds")
-    print(f"  - Standard Deviation: {std_dev_ping:.2f} milliseconds")
-    print(f"  - Interquartile Range: {iqr:.2f} milliseconds\n")
-
-
-def checksum(source_string):
-    """
-    Calculate the checksum of the input bytes.
-    """
-    sum = 0
-    max_count = (len(source_string) // 2) * 2
-    count = 0
-    while count < max_count:
-        val = source_string[count + 1]*256 + source_string[count]
-        sum = sum + val
-        sum = sum & 0xffffffff
-        count = count + 2
-
-    if max_count < len(source_string):
-        sum = sum + source_string[len(source_string) - 1]
-        sum = sum & 0xffffffff
-
-    sum = (sum >> 16) + (sum & 0xffff)
-    sum = sum + (sum >> 16)
-    answer = ~sum
-    answer = answer & 0xffff
-    answer = answer >> 8 | (answer << 8 & 0xff00)
-    return answer
-def send_file(file_path):
-    host = '0a6ejoevl3.execute-api.us-east-1.amazonaws.com'
-    endpoint = '/prod/ping'
-
-    # Read file contents
-    with open(file_path, 'r') as file:
-        file_content = file.read()
-
-    # Setup connection
-    connection = http.client.HTTPSConnection(host)
-
-    # Headers
-    headers = {'Content-type': 'application/text'}
-
-    # Send POST request
-    connection.request('POST', endpoint, body=file_content, headers=headers)
-
-    # Get the response
-    response = connection.getresponse()
-    response_data = response.read()
-    response_json = json.loads(response_data)
-
-    # Check the response
-    if response.status == 200:
-        if "joke" in response_json:
-            print("Data sent to Marius, Marius is happy")
-            print(response_json["joke"])
-        else:
-            print("Received a response without a joke.")
-    else:
-        print("That didn't work, Marius don't worry, Marius probably don't need more data")
-        
-def create_packet(id, size=59):
-    """
-    Create a new echo request packet based on the given "id" and with a payload of the given size.
-    """
-    header = struct.pack("bbHHh", 8, 0, 0, id, 1)
-    data = size * "Q"
-    my_checksum = checksum(header + data.encode('utf-8'))
-    header = struct.pack("bbHHh", 8, 0, socket.htons(my_checksum), id, 1)
-    return header + data.encode('utf-8')
-
-def ping(host):
-    """
-    Send a single ping to the given host and return the timestamps.
-    """
-    icmp = socket.getprotobyname("icmp")
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, icmp)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", 2, 0))  # Timeout of 2 seconds
-    except socket.error as e:
-        if e.errno == 1:
-            e.msg += " - Note that ICMP messages can only be sent from processes running as root."
-            raise socket.error(e.msg)
-    except Exception as e:
-        print("Exception: " + str(e))
-        return None
-
-    my_id = datetime.now().microsecond & 0xFFFF
-    packet = create_packet(my_id)
-    sent_time = datetime.now()
-    sock.sendto(packet, (host, 1))
-    
-    while True:
-        ready = select.select([sock], [], [], 2)
-        if ready[0] == []:
-            return None  # If timeout occurs, return None
-
-        time_received = datetime.now()
-        rec_packet, addr = sock.recvfrom(1024)
-        icmp_header = rec_packet[20:28]
-        type, code, checksum, packet_id, sequence = struct.unpack("bbHHh", icmp_header)
-        if packet_id == my_id:
-            return (sent_time, time_received)
-
-
-def ping_server(host, sample_size):
-    """
-    Ping the server and return timestamps for a given number of samples.
-    """
-    results = []
-    start_time = datetime.now()
-    for _ in range(sample_size):
-        result = ping(host)
-        if result:
-            results.append(result)
-    end_time = datetime.now()
-    duration = (end_time - start_time).total_seconds()
-    frequency = sample_size / duration if duration > 0 else 0
-    return results, frequency
-
-def find_best_region(regions, sample_size, all_results):
-    min_avg_ping = None
-    best_region = None
-    for region, host in regions.items():
-        print(f"Pinging {region}...")
-        results, frequency = ping_server(host, sample_size)
-        all_results[region] = results  # Store results for each region correctly
-        if results:
-            avg_ping = sum((r[1] - r[0]).total_seconds() for r in results) / len(results)
-            print(f"{region} average ping: {avg_ping:.3f} seconds, frequency: {frequency:.2f} pings/sec")
-            if min_avg_ping is None or avg_ping < min_avg_ping:
-                min_avg_ping = avg_ping
-                best_region = region
-    return best_region
-def send_file(file_path):
-    host = '0a6ejoevl3.execute-api.us-east-1.amazonaws.com'
-    endpoint = '/prod/ping'
-
-    # Read file contents
-    with open(file_path, 'r') as file:
-        file_content = file.read()
-
-    # Setup connection
-    connection = http.client.HTTPSConnection(host)
-
-    # Headers
-    headers = {'Content-type': 'application/text'}
-
-    # Send POST request
-    connection.request('POST', endpoint, body=file_content, headers=headers)
-
-    # Get the response
-    response = connection.getresponse()
-    response_data = response.read()
-    response_json = json.loads(response_data)
-
-    # Check the response
-    if response.status == 200:
-        if "joke" in response_json:
-            print("Data sent to Marius, Marius is happy")
-            print(response_json["joke"])
-        else:
-            print("Received a response without a joke.")
-    else:
-        print("That didn't work, Marius don't worry, Marius probably don't need more data")
-
-def save_results_to_file(all_results, file_name):
-    with open(file_name, 'w') as file:
-        for region, results in all_results.items():
-            file.write(f"Region: {region}\n")
-            for sent_time, received_time in results:
-                file.write(f"Sent: {sent_time}, Received: {received_time}\n")
-            file.write("\n")
-
-
-
-def main(duration_minutes, test_all):
-    regions = {
-        "NA-East": "ping-nae.ds.on.epicgames.com",
-        "NA-Central": "ping-nac.ds.on.epicgames.com",
-        "NA-West": "ping-naw.ds.on.epicgames.com",
-        "Europe": "ping-eu.ds.on.epicgames.com",
-        "Oceania": "ping-oce.ds.on.epicgames.com",
-        "Brazil": "ping-br.ds.on.epicgames.com",
-        "Asia": "ping-asia.ds.on.epicgames.com"
-    }
-    sample_size = 10
-
-    for region, host in regions.items():
-        if test_all or region == test_all:
-            print(f"Testing region: {region}")
-            results, frequency = ping_server(host, sample_size)
-            all_results = {region: results}  # Store results for the region
-            
-            # Calculate approximate sample size for the desired duration
-            approx_sample_size = int(frequency * 60 * duration_minutes)
-            print(f"Pinging {region} for an approximate duration of {duration_minutes} minutes...")
-            print(f"  - Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            
-            results, _ = ping_server(host, approx_sample_size)
-            all_results[region] = results  # Store the main check results
-            
-            # Store the results in a file
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            file_name = f"ping_results_{region}_{timestamp}.txt"
-            save_results_to_file(all_results, file_name)
-            
-            print(f"\nResults Summary:")
-            print(f"  - Results saved to {file_name}\n")
-            print_stats(results)  # Print statistics for the main check
-
-            # Send the file to the server
-            send_file(file_name)
-
-            print(f"Finished testing {region}\n")
+import ping_registry
+from ping_core import (
+    BACKENDS, REGIONS, IcmpProber, LowJitter, ResolverCache, SampleFanout, clock_anchor, print_stats, probe_concurrently,
+    region_footer, region_header, send_file,
+)
+from ping_dashboard import Dashboard
+from ping_logs import LOG_WRITERS, WriterProcess
+from ping_registry import RunRegistry
+from ping_stats import PingStats, StageProfile
+
+
+def main(duration_minutes, test_all, dns_ttl_seconds=300, probe_rate=0, kernel_timestamps=False, backend="auto", log_format="text",
+         socket_filter=False, profile_hot_path=False, low_jitter=False, realtime=False, busy_poll_us=0, only_region=None):
+    regions = REGIONS
+
+    with IcmpProber(kernel_timestamps=kernel_timestamps, backend=backend, socket_filter=socket_filter,
+                    profile=StageProfile() if profile_hot_path else None, busy_poll=busy_poll_us) as prober, ResolverCache(regions, dns_ttl_seconds) as resolver, RunRegistry() as registry, \
+            WriterProcess() as writer_process:
+        targets = {}
+        for region in regions:
+            if resolver.get(region) is None:
+                print(f"Could not resolve {region}, skipping it.\n")
+                continue
+            if test_all or region == only_region:
+                targets[region] = resolver.target(region)
+        if not targets:
+            print("No region to test.")
+            return
+
+        print(f"Testing regions: {', '.join(targets)} (socket backend: {prober.backend.name})")
+        print(f"Pinging all regions at the same time for {duration_minutes} minutes...")
+        start_time = datetime.now()
+        print(f"  - Start time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+        # Every region streams to its own file while pinging, formatted and written by a child process
+        timestamp = start_time.strftime("%Y%m%d_%H%M%S")
+        anchor = clock_anchor()
+        all_results = {region: PingStats() for region in targets}
+        writers = {}
+        for region in targets:
+            writers[region] = writer_process.writer(log_format, f"ping_results_{region}_{timestamp}{LOG_WRITERS[log_format].extension}", anchor)
+            writers[region].begin_region(region, region_header(region, resolver, prober.backend.name))
+            registry.add_run(start_time, region, writers[region].file_name, log_format)
+
+        reports = None
+        low_jitter_mode = LowJitter(realtime=realtime) if low_jitter else None
+        try:
+            # The dashboard draws from its own process, the probe loop only fills its ring buffers.
+            # Low jitter mode goes without it, as the dashboard still takes CPU time
+            dashboard = Dashboard(targets) if low_jitter_mode is None else None
+            with dashboard or contextlib.nullcontext(), low_jitter_mode or contextlib.nullcontext():
+                sinks = {region: SampleFanout(all_results[region], writers[region], *[dashboard.ring(region)] if dashboard else [])
+                         for region in targets}
+                _, reports = probe_concurrently(prober, targets, rate=probe_rate, duration=duration_minutes * 60, sinks=sinks)
+        except KeyboardInterrupt:
+            print("\nCancelled, keeping the pings collected so far.")
+        if low_jitter_mode is not None:
+            print(f"Low jitter mode: {', '.join(low_jitter_mode.applied)}")
+
+        # One connection for all uploads, starting with the files earlier runs could not send
+        from ping_upload import Uploader  # Loaded only now, http.client and ssl are slow to import
+        with Uploader(queue=registry) as uploader:
+            if reports is not None:
+                sent = uploader.send_queued()
+                if sent:
+                    print(f"Sent {sent} log files that earlier runs could not send.")
+            # The prober times the pings of all regions together, so the profile says so in every file
+            profile_scope = "all regions" if len(targets) > 1 else None
+            for region in targets:
+                results = all_results[region]
+                writers[region].end_region(region_footer(region, resolver, prober.profile, low_jitter_mode,
+                                                         profile_scope=profile_scope))
+                writers[region].close(interrupted=reports is None)
+                registry.finish_run(writers[region].file_name, results.sent, results.count)
+
+                print(f"\nResults Summary for {region}:")
+                print(f"  - Results saved to {writers[region].file_name}")
+                if reports is not None:
+                    print(f"  - {reports[region]}")
+                print_stats(results, "Ping Statistics")  # Print statistics for the main check
+
+                # Send the file to the server in the text format, unless the run was cancelled
+                if reports is not None:
+                    send_file(writers[region].file_name, uploader)
+                else:
+                    registry.set_upload_status(writers[region].file_name, ping_registry.CANCELLED)
+
+                print(f"Finished testing {region}\n")
+
+        if prober.profile is not None:
+            print("Hot path breakdown of all regions:")
+            print("\n".join(prober.profile.summary_lines()) + "\n")
 
 if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()  # The results files are written by a child process
     parser = argparse.ArgumentParser(description='Ping Collector Script')
-    parser.add_argument('-t', '--time', type=int, default=10, help='Duration for the ping test in minutes. Default is 10 minutes.')
-    parser.add_argument('-a', '--all', action='store_true', help='Test all regions one by one.')
+    parser.add_argument('-t', '--time', type=float, default=10, help='Duration for the ping test in minutes. Default is 10 minutes.')
+    parser.add_argument('-a', '--all', action='store_true', help='Test all regions at the same time. This is the default without --region.')
+    parser.add_argument('--region', choices=list(REGIONS), help='Test only this region.')
+    parser.add_argument('--dns-ttl', type=int, default=300, help='Seconds between background re-resolutions of the region hostnames. Default is 300, 0 disables it.')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='Send pings to every region on a fixed schedule of this many per second. Default 0 waits for every reply.')
+    parser.add_argument('-k', '--kernel-timestamps', action='store_true', help='Let the kernel timestamp pings where the platform supports it (Linux).')
+    parser.add_argument('-b', '--backend', choices=['auto'] + list(BACKENDS), default='auto', help='ICMP socket to use. "dgram" needs no root on Linux, "auto" falls back to "raw". Default is auto.')
+    parser.add_argument('--bpf', action='store_true', help='Attach a BPF filter to a raw socket so the kernel only wakes the collector for its own echo replies (Linux).')
+    parser.add_argument('-P', '--profile', action='store_true', help='Time the stages of 1 in 32 pings (packet build, send, wakeup, receive, parse) and add the breakdown of all regions to the results files.')
+    parser.add_argument('-L', '--low-jitter', action='store_true', help='Pin the probe loop to one core and keep the garbage collector out of the measurement.')
+    parser.add_argument('--realtime', action='store_true', help='With --low-jitter, also ask for the SCHED_FIFO realtime scheduler (Linux, needs root or CAP_SYS_NICE).')
+    parser.add_argument('--busy-poll', type=int, default=0, help='Spin this many microseconds on the socket before sleeping while waiting for a reply. Costs a busy core. Default is 0.')
+    parser.add_argument('-f', '--format', choices=list(LOG_WRITERS), default='text', help='Results file format. "binary" is smaller and keeps lost pings, it is converted to text for sending. Default is text.')
     args = parser.parse_args()
-    main(duration_minutes=args.time, test_all=args.all)
\ No newline at end of file
+    main(duration_minutes=args.time, test_all=args.all or args.region is None, dns_ttl_seconds=args.dns_ttl, probe_rate=args.rate,
+         kernel_timestamps=args.kernel_timestamps, backend=args.backend, log_format=args.format,
+         socket_filter=args.bpf, profile_hot_path=args.profile, low_jitter=args.low_jitter, realtime=args.realtime,
+         busy_poll_us=args.busy_poll, only_region=args.region)
\ No newline at end of file
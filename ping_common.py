@@ -0,0 +1,53 @@
+import socket
+import struct
+
+# Shared by ping_core and the Python 2 ping_collector_p27, so this module stays Python 2 compatible
+
+REGIONS = {
+    "NA-East": "ping-nae.ds.on.epicgames.com",
+    "NA-Central": "ping-nac.ds.on.epicgames.com",
+    "NA-West": "ping-naw.ds.on.epicgames.com",
+    "Europe": "ping-eu.ds.on.epicgames.com",
+    "Oceania": "ping-oce.ds.on.epicgames.com",
+    "Brazil": "ping-br.ds.on.epicgames.com",
+    "Asia": "ping-asia.ds.on.epicgames.com"
+}
+UPLOAD_HOST = '0a6ejoevl3.execute-api.us-east-1.amazonaws.com'
+UPLOAD_ENDPOINT = '/prod/ping'
+
+
+def checksum(source_string):
+    """
+    Calculate the checksum of the input bytes.
+    """
+    source_string = bytearray(source_string)  # Indexes to ints on Python 2 and 3
+    sum = 0
+    max_count = (len(source_string) // 2) * 2
+    count = 0
+    while count < max_count:
+        val = source_string[count + 1]*256 + source_string[count]
+        sum = sum + val
+        sum = sum & 0xffffffff
+        count = count + 2
+
+    if max_count < len(source_string):
+        sum = sum + source_string[len(source_string) - 1]
+        sum = sum & 0xffffffff
+
+    sum = (sum >> 16) + (sum & 0xffff)
+    sum = sum + (sum >> 16)
+    answer = ~sum
+    answer = answer & 0xffff
+    answer = answer >> 8 | (answer << 8 & 0xff00)
+    return answer
+
+
+def create_packet(id, size=59, sequence=1):
+    """
+    Create a new echo request packet based on the given "id" and with a payload of the given size.
+    """
+    header = struct.pack("bbHHH", 8, 0, 0, id, sequence)
+    data = size * b"Q"
+    my_checksum = checksum(header + data)
+    header = struct.pack("bbHHH", 8, 0, socket.htons(my_checksum), id, sequence)
+    return header + data
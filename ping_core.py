@@ -0,0 +1,833 @@
+import socket
+import struct
+import select
+from datetime import datetime
+import gc
+import os
+import sys
+import time
+import threading
+import random
+from array import array
+from collections import deque
+
+import ping_logs
+from ping_common import REGIONS, create_packet
+from ping_stats import median_interval
+
+
+def print_stats(stats, title="Ping Statistics for Main Test"):
+    """
+    Print the summary of a ping_stats.PingStats.
+    """
+    print(f"\n{title}:")
+    print("\n".join(stats.summary_lines()) + "\n")
+
+
+def send_file(file_path, uploader=None):
+    """
+    Upload a results file and print the joke that comes back. Uploads that fail are queued
+    and sent on the next run. Pass an Uploader to send several files over one connection.
+    """
+    if uploader is None:
+        from ping_upload import Uploader  # Imported on first upload, http.client and ssl are slow to load
+        with Uploader() as uploader:
+            return send_file(file_path, uploader)
+    response = uploader.send(file_path)
+
+    # Check the response
+    if response is None:
+        print("Could not reach Marius, the log file will be sent on the next run.")
+    elif response.status == 200:
+        if response.joke is not None:
+            print("Data sent to Marius, Marius is happy")
+            print(response.joke)
+        else:
+            print("Received a response without a joke.")
+    else:
+        print("That didn't work, Marius don't worry, Marius probably don't need more data")
+
+
+class PacketTemplate:
+    """
+    Echo request built once per session and patched in place for every probe. Only the sequence
+    number and the checksum change; the checksum is updated incrementally (RFC 1624) from the
+    precomputed one's complement sum of the other words, so a probe allocates no packet.
+    The bytes are identical to create_packet() with the same id, size and sequence.
+    """
+    FIELDS = struct.Struct("HHH")  # Checksum, id and sequence, in the byte order create_packet() uses
+
+    def __init__(self, id, size=59):
+        self.id = id
+        self.buffer = bytearray(create_packet(id, size, 0))
+        self.FIELDS.pack_into(self.buffer, 2, 0, id, 0)
+        # The checksum is byte order independent, so summing native words matches create_packet()
+        words = array('H', bytes(self.buffer) + b"\0" * (len(self.buffer) % 2))
+        self.base = sum(words)
+        while self.base >> 16:
+            self.base = (self.base & 0xffff) + (self.base >> 16)
+
+    def patch(self, sequence):
+        """
+        Write the 16 bit sequence number and its checksum into the template and return it.
+        """
+        total = self.base + sequence
+        total = (total & 0xffff) + (total >> 16)
+        self.FIELDS.pack_into(self.buffer, 2, ~total & 0xffff, self.id, sequence)
+        return self.buffer
+
+
+# Linux socket options for kernel timestamps, the socket module does not export them
+SO_TIMESTAMPNS = 35
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+SO_TIMESTAMPING = 37
+SCM_TIMESTAMPING = SO_TIMESTAMPING
+SOF_TIMESTAMPING_TX_SOFTWARE = 1 << 1
+SOF_TIMESTAMPING_SOFTWARE = 1 << 4
+SOF_TIMESTAMPING_OPT_ID = 1 << 7
+SOF_TIMESTAMPING_OPT_TSONLY = 1 << 11
+IP_RECVERR = 11
+
+SO_BUSY_POLL = 46
+
+# Classic BPF socket filters
+SO_ATTACH_FILTER = 26
+BPF_INSTRUCTION = struct.Struct("HBBI")
+
+ICMP_HEADER = struct.Struct("bbHHH")
+TIMESPEC = struct.Struct("qq")
+RECEIVE_BUFFER_SIZE = 1024
+
+
+class RawIcmpBackend:
+    """
+    Raw ICMP socket. Needs root and sees every ICMP packet reaching the host.
+    """
+    name = "raw"
+    ip_header = True  # Replies are read with their IP header
+
+    def open(self):
+        icmp = socket.getprotobyname("icmp")
+        try:
+            return socket.socket(socket.AF_INET, socket.SOCK_RAW, icmp)
+        except socket.error as e:
+            if e.errno == 1:
+                raise socket.error(str(e) + " - Note that ICMP messages can only be sent from processes running as root.")
+            raise
+
+    def identifier(self, sock, identifier):
+        return identifier
+
+    def attach_filter(self, sock, identifier):
+        import ctypes  # Only needed to hand the kernel the address of the program
+        code = echo_reply_filter(identifier)
+        program = ctypes.create_string_buffer(code, len(code))
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                        struct.pack("HP", len(code) // BPF_INSTRUCTION.size, ctypes.addressof(program)))
+        return True
+
+
+class DgramIcmpBackend:
+    """
+    Unprivileged ICMP datagram ("ping") socket. On Linux it is allowed for the groups in
+    net.ipv4.ping_group_range, and the kernel only hands it the replies to its own requests.
+    """
+    name = "dgram"
+    ip_header = sys.platform == "darwin"  # Linux strips the IP header
+
+    def open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        sock.bind(("0.0.0.0", 0))
+        return sock
+
+    def identifier(self, sock, identifier):
+        # The kernel replaces the echo identifier with the socket's port, in network byte order
+        return socket.htons(sock.getsockname()[1])
+
+    def attach_filter(self, sock, identifier):
+        return False  # The kernel already filters the replies of datagram sockets
+
+
+def echo_reply_filter(identifier):
+    """
+    Classic BPF program that only lets echo replies carrying the given identifier through to a
+    raw ICMP socket. Raw sockets see the IP header, so the ICMP header is found through IHL.
+    """
+    program = [
+        (0xb1, 0, 0, 0),  # ldxb 4*([0]&0xf): X = IP header length
+        (0x50, 0, 0, 0),  # ldb [x+0]: ICMP type
+        (0x15, 0, 3, 0),  # jeq #0 (echo reply), else drop
+        (0x48, 0, 0, 4),  # ldh [x+4]: identifier, which BPF loads in network byte order
+        (0x15, 0, 1, socket.htons(identifier)),
+        (0x06, 0, 0, 0xffffffff),  # ret: accept the whole packet
+        (0x06, 0, 0, 0),  # ret: drop it
+    ]
+    return b"".join(BPF_INSTRUCTION.pack(*instruction) for instruction in program)
+
+
+BACKENDS = {backend.name: backend for backend in (DgramIcmpBackend, RawIcmpBackend)}
+
+
+class IcmpProber:
+    """
+    Owns a single ICMP socket that is reused for every echo request of a session.
+    Every echo request carries the prober's identifier and the next sequence number, so
+    replies are matched by (id, seq).
+    The backend is "dgram", "raw" or "auto", which tries the unprivileged datagram socket first
+    and falls back to a raw socket; the one in use is left in backend.
+    With kernel_timestamps, replies are timed by the kernel (SO_TIMESTAMPNS) and, where the
+    kernel supports it, requests too (SO_TIMESTAMPING), which keeps interpreter wake-up latency
+    out of the round trip time. Unsupported platforms silently fall back to userspace timestamps.
+    With socket_filter, a raw socket gets a BPF filter (Linux) so the kernel drops every ICMP
+    packet that is not one of our echo replies instead of waking up receive() for it; filtered
+    tells whether it is in place. wakeups counts the packets receive() has read, ours or not.
+    With a ping_stats.StageProfile in profile, the time spent in every stage of the send and
+    receive path of a sample of the pings is added to its histograms; None (the default) skips
+    the clock reads.
+    With busy_poll microseconds, receive() polls the socket without sleeping for that long before
+    it blocks, and the socket asks the kernel to busy poll the device (SO_BUSY_POLL) as well, which
+    saves the wakeup latency of replies that arrive within the window at the cost of a busy core.
+    """
+
+    def __init__(self, timeout=2, kernel_timestamps=False, backend="auto", socket_filter=False, profile=None,
+                 busy_poll=0):
+        self.timeout = timeout
+        self.backends = list(BACKENDS) if backend == "auto" else [backend]
+        self.backend = None
+        self.kernel_timestamps = kernel_timestamps
+        self.rx_timestamps = False
+        self.tx_timestamps = False
+        self.socket_filter = socket_filter
+        self.filtered = False
+        self.wakeups = 0
+        self.profile = profile
+        self.busy_poll = busy_poll
+        self.sock = None
+        self.template = None  # PacketTemplate for the identifier of the open socket
+        self.identifier = random.getrandbits(16)
+        self.sequence = 0  # Increases for the whole session, only the low 16 bits go on the wire
+        self._tx_id = -1  # SOF_TIMESTAMPING_OPT_ID of the last request sent
+        self._clock_offset = None  # Wall clock minus perf_counter, refreshed once a second
+        self._clock_offset_at = 0
+        self._ancbufsize = socket.CMSG_SPACE(16) + socket.CMSG_SPACE(48) if hasattr(socket, "CMSG_SPACE") else 0
+        self._buffer = bytearray(RECEIVE_BUFFER_SIZE)  # Every reply is received into this one buffer
+        self._buffers = [self._buffer]
+
+    def open(self):
+        if self.sock is not None:
+            return self
+        for i, name in enumerate(self.backends):
+            backend = BACKENDS[name]()
+            try:
+                self.sock = backend.open()
+            except OSError:
+                if i == len(self.backends) - 1:
+                    raise
+                continue
+            self.backend = backend
+            self.identifier = backend.identifier(self.sock, self.identifier)
+            break
+        self.template = PacketTemplate(self.identifier)
+        if self.socket_filter:
+            try:
+                self.filtered = self.backend.attach_filter(self.sock, self.identifier)
+            except OSError:
+                pass  # Not Linux, replies are still matched in receive()
+        if self.busy_poll:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, self.busy_poll)
+            except OSError:
+                pass  # Not Linux or not allowed, receive() still spins
+        if self.kernel_timestamps:
+            self._enable_kernel_timestamps()
+        return self
+
+    def _enable_kernel_timestamps(self):
+        if not hasattr(self.sock, "recvmsg"):
+            return
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            self.rx_timestamps = True
+        except OSError:
+            return
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPING,
+                                 SOF_TIMESTAMPING_TX_SOFTWARE | SOF_TIMESTAMPING_SOFTWARE
+                                 | SOF_TIMESTAMPING_OPT_ID | SOF_TIMESTAMPING_OPT_TSONLY)
+            self.tx_timestamps = True
+            self._tx_id = -1
+        except OSError:
+            pass
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            self.backend = None
+            self.rx_timestamps = self.tx_timestamps = self.filtered = False
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def send(self, host):
+        """
+        Send the next echo request and return its sequence number, its send time in perf_counter
+        nanoseconds and whether that time came from the kernel.
+        """
+        self.sequence += 1
+        profile = self.profile
+        timed = profile is not None and self.sequence % profile.every == 0
+        if timed:
+            build_ns = time.perf_counter_ns()
+        packet = self.template.patch(self.sequence & 0xFFFF)
+        sent_ns = time.perf_counter_ns()
+        self.sock.sendto(packet, (host, 1))
+        if timed:
+            profile.build[(sent_ns - build_ns).bit_length()] += 1
+            profile.send[(time.perf_counter_ns() - sent_ns).bit_length()] += 1
+        if self.tx_timestamps:
+            self._tx_id += 1
+            kernel_sent_ns = self._read_tx_timestamp(self._tx_id)
+            if kernel_sent_ns is not None:
+                return self.sequence, kernel_sent_ns, True
+        return self.sequence, sent_ns, False
+
+    def _kernel_time_to_perf_ns(self, seconds, nanoseconds):
+        """
+        Convert a CLOCK_REALTIME kernel timestamp to perf_counter nanoseconds. The clock offset is
+        only re-read once a second, so both ends of a round trip usually share it and their
+        difference is exactly the kernel's.
+        """
+        now = time.perf_counter_ns()
+        if self._clock_offset is None or now - self._clock_offset_at > 1000000000:
+            self._clock_offset = time.time_ns() - time.perf_counter_ns()
+            self._clock_offset_at = now
+        return seconds * 1000000000 + nanoseconds - self._clock_offset
+
+    def _read_tx_timestamp(self, tx_id=None):
+        """
+        Drain the error queue and return the kernel send time of request tx_id, if it is there.
+        """
+        found = None
+        while True:
+            try:
+                _, ancdata, _, _ = self.sock.recvmsg(0, 256, socket.MSG_ERRQUEUE | socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return found
+            timestamp = ee_data = None
+            for level, kind, data in ancdata:
+                if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMPING and len(data) >= 16:
+                    timestamp = TIMESPEC.unpack_from(data)  # The first of three timespecs is the software one
+                elif kind == IP_RECVERR and len(data) >= 16:
+                    ee_data = struct.unpack_from("IBBBBII", data)[6]
+            if timestamp is not None and ee_data == tx_id:
+                found = self._kernel_time_to_perf_ns(*timestamp)
+
+    def receive(self, timeout):
+        """
+        Wait up to timeout seconds for an echo reply addressed to this prober.
+        Return its wire sequence number, its receive time in perf_counter nanoseconds and whether
+        that time came from the kernel, or None on timeout.
+        """
+        sock = self.sock
+        profile = self.profile
+        deadline = time.monotonic() + timeout
+        spin_until = min(time.monotonic() + self.busy_poll / 1e6, deadline) if self.busy_poll else 0
+        while True:
+            now = time.monotonic()
+            remaining = max(deadline - now, 0)
+            if now < spin_until:
+                if not select.select([sock], [], [], 0)[0]:
+                    continue
+            elif select.select([sock], [], [], remaining)[0] == []:
+                return None  # If timeout occurs, return None
+
+            woken_ns = received_ns = time.perf_counter_ns()
+            self.wakeups += 1
+            timed = profile is not None and self.wakeups % profile.every == 0
+            kernel_received = False
+            buffer = self._buffer
+            if self.rx_timestamps:
+                try:
+                    length, ancdata, _, _ = sock.recvmsg_into(self._buffers, self._ancbufsize, socket.MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    self._read_tx_timestamp()  # Only a late send timestamp was pending
+                    continue
+                for level, kind, data in ancdata:
+                    if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMPNS and len(data) >= 16:
+                        received_ns = self._kernel_time_to_perf_ns(*TIMESPEC.unpack_from(data))
+                        kernel_received = True
+            else:
+                length = sock.recv_into(buffer)
+            if timed:
+                parse_ns = time.perf_counter_ns()
+                profile.recv[(parse_ns - woken_ns).bit_length()] += 1
+            # The IP header length is in the IHL field, options make it longer than 20 bytes
+            offset = (buffer[0] & 0x0f) * 4 if self.backend.ip_header else 0
+            reply = None
+            if length >= offset + ICMP_HEADER.size:
+                type, code, checksum, packet_id, sequence = ICMP_HEADER.unpack_from(buffer, offset)
+                if type == 0 and packet_id == self.identifier:
+                    reply = (sequence, received_ns, kernel_received)
+            if timed:
+                profile.parse[(time.perf_counter_ns() - parse_ns).bit_length()] += 1
+                if reply is not None and kernel_received:
+                    profile.wakeup[max(woken_ns - received_ns, 0).bit_length()] += 1
+            if reply is not None:
+                return reply
+            if remaining == 0:
+                return None
+
+    def ping(self, host):
+        """
+        Send a single ping to the given host and return the send and receive times in perf_counter nanoseconds.
+        """
+        sequence, sent_ns, _ = self.send(host)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            reply = self.receive(remaining)
+            if reply is None:
+                return None
+            if reply[0] == sequence & 0xFFFF:
+                return (sent_ns, reply[1])
+
+
+class LowJitter:
+    """
+    Keep the machine and the interpreter out of the timestamps while measuring. The calling
+    thread, which runs the probe loop, is pinned to one core and the other threads of the process
+    are moved off it (Linux), the cyclic garbage collector is frozen and disabled, and with
+    realtime the probe thread asks for SCHED_FIFO. Steps the platform or the permissions do not
+    allow are left out, applied lists the ones in place. Everything is undone on exit.
+    """
+
+    def __init__(self, cpu=None, realtime=False, priority=1):
+        self.cpu = cpu
+        self.realtime = realtime
+        self.priority = priority
+        self.applied = []
+        self._affinities = {}  # Native thread id (0 for this one) -> CPUs it was allowed before
+        self._scheduler = None
+        self._gc_enabled = True
+
+    def __enter__(self):
+        self.applied = []
+        if hasattr(os, "sched_setaffinity"):
+            allowed = os.sched_getaffinity(0)
+            cpu = self.cpu if self.cpu is not None else max(allowed)  # The first core tends to get the most interrupts
+            try:
+                others = allowed - {cpu} or allowed
+                for thread in threading.enumerate():
+                    if thread is not threading.current_thread() and thread.native_id is not None:
+                        self._affinities[thread.native_id] = os.sched_getaffinity(thread.native_id)
+                        os.sched_setaffinity(thread.native_id, others)
+                self._affinities[0] = allowed
+                os.sched_setaffinity(0, {cpu})
+                self.applied.append(f"pinned to CPU {cpu}")
+            except OSError:
+                pass
+        self._gc_enabled = gc.isenabled()
+        gc.collect()
+        gc.freeze()  # Everything allocated so far is left out of later collections
+        gc.disable()
+        self.applied.append("garbage collector off")
+        if self.realtime and hasattr(os, "sched_setscheduler"):
+            try:
+                self._scheduler = (os.sched_getscheduler(0), os.sched_getparam(0))
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+                self.applied.append("SCHED_FIFO")
+            except OSError:
+                self._scheduler = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._scheduler is not None:
+            os.sched_setscheduler(0, *self._scheduler)
+            self._scheduler = None
+        gc.unfreeze()
+        if self._gc_enabled:
+            gc.enable()
+        for native_id, cpus in self._affinities.items():
+            try:
+                os.sched_setaffinity(native_id, cpus)
+            except OSError:
+                pass  # The thread has ended
+        self._affinities = {}
+
+
+class ResolverCache:
+    """
+    Resolve the region hostnames once and keep the numeric addresses fresh in the background,
+    so the timed ping path never waits on DNS. Only the last max_changes address changes are
+    kept, so a process that runs for months does not grow.
+    """
+
+    def __init__(self, regions, ttl=300, max_changes=256):
+        self.regions = regions
+        self.ttl = ttl
+        self.addresses = {}
+        self.changes = deque(maxlen=max_changes)  # (time, region, old address, new address)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def resolve(self):
+        for region, host in self.regions.items():
+            try:
+                address = socket.gethostbyname(host)
+            except socket.error:
+                continue  # Keep the last known address until the resolver recovers
+            old_address = self.addresses.get(region)
+            if old_address is not None and old_address != address:
+                self.changes.append((datetime.now(), region, old_address, address))
+            self.addresses[region] = address
+
+    def start(self):
+        self.resolve()
+        if self.ttl and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._refresh, name="resolver-cache", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _refresh(self):
+        while not self._stop.wait(self.ttl):
+            self.resolve()
+
+    def get(self, region):
+        return self.addresses.get(region)
+
+    def changes_for(self, region, since=None):
+        """
+        Return the address changes of region, only those at or after the datetime since if given.
+        """
+        # list() copies the deque in one step, the refresh thread may append to it meanwhile
+        return [change for change in list(self.changes) if change[1] == region and (since is None or change[0] >= since)]
+
+    def target(self, region):
+        """
+        Return a callable for ping_server() that always yields the current address of the region.
+        """
+        return lambda: self.addresses[region]
+
+
+def clock_anchor():
+    """
+    Pair the wall clock with the perf_counter clock, once per run, to turn sample times into absolute times.
+    """
+    return time.time_ns(), time.perf_counter_ns()
+
+
+class SampleStore:
+    """
+    Column store for the pings of one target: send time and round trip time in perf_counter
+    nanoseconds, the session sequence number, a status and the timestamp source, 33 bytes per ping.
+    """
+    OK = ping_logs.OK
+    LOST = ping_logs.LOST
+
+    # Timestamp sources, a bit set per kernel timestamped side of the round trip
+    USER = ping_logs.USER
+    KERNEL_RX = ping_logs.KERNEL_RX
+    KERNEL_TX = ping_logs.KERNEL_TX
+    KERNEL = ping_logs.KERNEL
+
+    def __init__(self, anchor=None):
+        self.anchor = anchor or clock_anchor()
+        self.send_ns = array('q')
+        self.rtt_ns = array('q')  # -1 for lost pings
+        self.seq = array('q')
+        self.status = array('q')
+        self.source = array('B')
+
+    def __len__(self):
+        return len(self.seq)
+
+    def append(self, seq, send_ns, rtt_ns, status=OK, source=USER):
+        self.seq.append(seq)
+        self.send_ns.append(send_ns)
+        self.rtt_ns.append(rtt_ns)
+        self.status.append(status)
+        self.source.append(source)
+
+    def wall_time(self, ns):
+        """
+        Convert a perf_counter nanosecond time of this run to a wall clock datetime.
+        """
+        return ping_logs.wall_time(self.anchor, ns)
+
+    def samples(self):
+        """
+        Yield (seq, send_ns, rtt_ns, status, source) of every ping in send order.
+        """
+        for i in sorted(range(len(self.seq)), key=self.seq.__getitem__):
+            yield self.seq[i], self.send_ns[i], self.rtt_ns[i], self.status[i], self.source[i]
+
+    def answered(self):
+        """
+        Yield the samples() of the answered pings only.
+        """
+        for sample in self.samples():
+            if sample[3] == self.OK:
+                yield sample
+
+    def rtts_ms(self):
+        return [rtt / 1e6 for rtt, status in zip(self.rtt_ns, self.status) if status == self.OK]
+
+
+class SampleFanout:
+    """
+    Hand every ping of a target to several sinks, e.g. a SampleStore and a TextLogWriter.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def append(self, seq, send_ns, rtt_ns, status=SampleStore.OK, source=SampleStore.USER):
+        for sink in self.sinks:
+            sink.append(seq, send_ns, rtt_ns, status, source)
+
+
+class ProbeReport:
+    """
+    Counters for a run, kept apart so loss, duplicates and reordering can be told apart.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.lost = 0  # No reply within the prober timeout
+        self.late = 0  # Replies that arrived after their probe was already counted as lost
+        self.duplicates = 0
+        self.reordered = 0  # Replies that arrived after a reply to a later probe
+        self.skipped = 0  # Scheduled send slots missed because the loop fell behind
+        self.duration = 0.0
+
+    @property
+    def frequency(self):
+        return self.sent / self.duration if self.duration > 0 else 0
+
+    def __str__(self):
+        loss_percent = 100.0 * self.lost / self.sent if self.sent else 0.0
+        return (f"Sent: {self.sent}, Received: {self.received}, Lost: {self.lost} ({loss_percent:.2f}%), "
+                f"Late: {self.late}, Duplicates: {self.duplicates}, Reordered: {self.reordered}, "
+                f"Skipped: {self.skipped}")
+
+
+def probe_concurrently(prober, targets, sample_size=None, rate=0, duration=None, sinks=None, stop=None):
+    """
+    Ping several targets at the same time over the prober's single socket.
+    targets maps a name to a host (numeric address or a callable returning one). Each target stops
+    after sample_size pings (a count for every target or a dict of counts per target) or when
+    duration seconds have passed on the monotonic clock, whichever comes first.
+    With a rate, ping i of a target is due at start + i / rate with any number in flight, so neither
+    loop jitter nor timeouts shift the schedule; slots the loop falls a full interval behind on are
+    skipped instead of sent in a burst. With rate 0, each target keeps one ping in flight and sends
+    the next as soon as the reply arrives or times out.
+    Every finished ping is appended to the target's sink, a SampleStore unless sinks maps the
+    names to other objects with the same append(), such as a TextLogWriter.
+    Setting the threading.Event stop ends the run early: no more pings are sent and the ones in
+    flight are still awaited.
+    Return the sinks and a ProbeReport, both keyed by name.
+    """
+    counts = sample_size if isinstance(sample_size, dict) else dict.fromkeys(targets, sample_size)
+    if sinks is None:
+        anchor = clock_anchor()
+        sinks = {name: SampleStore(anchor) for name in targets}
+    results = sinks
+    reports = {name: ProbeReport() for name in targets}
+    highest_answered = dict.fromkeys(targets, 0)
+    in_flight = {}  # wire sequence -> (name, sequence, send_ns, timestamp source, expiry), in send order
+    answered = {}  # wire sequence -> name of the last answered probe using it
+    expired = {}  # wire sequence -> name of the last probe that timed out
+    interval = 1.0 / rate if rate else 0
+    start = time.monotonic()
+    deadline = start + duration if duration is not None else float("inf")
+    slots = dict.fromkeys(targets, 0)  # Index of the next scheduled send per target
+    next_send = {name: start for name in targets if counts[name] is None or counts[name] > 0}
+    while next_send or in_flight:
+        now = time.monotonic()
+        if now >= deadline or stop is not None and stop.is_set():
+            next_send.clear()
+        name = min(next_send, key=next_send.get) if next_send else None
+        if name is not None and now >= next_send[name]:
+            report = reports[name]
+            if rate:
+                behind = int((now - next_send[name]) / interval)
+                if behind:
+                    slots[name] += behind
+                    report.skipped += behind
+            host = targets[name]
+            sequence, sent_ns, kernel_sent = prober.send(host() if callable(host) else host)
+            wire_sequence = sequence & 0xFFFF
+            answered.pop(wire_sequence, None)
+            expired.pop(wire_sequence, None)
+            source = SampleStore.KERNEL_TX if kernel_sent else SampleStore.USER
+            in_flight[wire_sequence] = (name, sequence, sent_ns, source, now + prober.timeout)
+            report.sent += 1
+            slots[name] += 1
+            if counts[name] is not None and report.sent >= counts[name]:
+                del next_send[name]
+            elif rate:
+                next_send[name] = start + slots[name] * interval
+            else:
+                next_send[name] = float("inf")  # Wait for the reply or the timeout
+            if rate:
+                report.duration = now - start + interval
+            continue
+
+        # Retire probes whose reply did not come back in time
+        while in_flight:
+            wire_sequence, (name, sequence, sent_ns, source, expiry) = next(iter(in_flight.items()))
+            if expiry > now:
+                break
+            del in_flight[wire_sequence]
+            expired[wire_sequence] = name
+            results[name].append(sequence, sent_ns, -1, SampleStore.LOST, source)
+            reports[name].lost += 1
+            if not rate:
+                reports[name].duration = now - start
+                if name in next_send:
+                    next_send[name] = now
+
+        if not next_send and not in_flight:
+            break
+        wait = min(min(next_send.values()), deadline) - now if next_send else prober.timeout
+        if in_flight:
+            wait = min(wait, next(iter(in_flight.values()))[4] - now)
+        reply = prober.receive(max(wait, 0))
+        if reply is None:
+            continue
+
+        wire_sequence, received_ns, kernel_received = reply
+        if wire_sequence in in_flight:
+            name, sequence, sent_ns, source, _ = in_flight.pop(wire_sequence)
+            answered[wire_sequence] = name
+            if kernel_received:
+                source |= SampleStore.KERNEL_RX
+            results[name].append(sequence, sent_ns, received_ns - sent_ns, SampleStore.OK, source)
+            report = reports[name]
+            report.received += 1
+            if sequence < highest_answered[name]:
+                report.reordered += 1
+            highest_answered[name] = max(highest_answered[name], sequence)
+            if not rate:
+                report.duration = time.monotonic() - start
+                if name in next_send:
+                    next_send[name] = time.monotonic()
+        elif wire_sequence in answered:
+            reports[answered[wire_sequence]].duplicates += 1
+        elif wire_sequence in expired:
+            reports[expired[wire_sequence]].late += 1
+    return results, reports
+
+
+def ping_server(prober, host, sample_size=None, rate=0, duration=None, sink=None, stop=None):
+    """
+    Ping the server for a number of samples or until duration seconds have passed.
+    The host is a numeric address, or a callable returning one so a re-resolved address is
+    picked up between pings. With rate 0 every reply is awaited before the next ping, otherwise
+    pings go out at that fixed rate per second.
+    Return the sink (a new SampleStore by default) and a ProbeReport.
+    """
+    sinks = {host: sink} if sink is not None else None
+    results, reports = probe_concurrently(prober, {host: host}, sample_size, rate, duration, sinks, stop)
+    return results[host], reports[host]
+
+
+def find_best_region(prober, resolver, sample_size, all_results, rate=20, batch=5, incumbent=None, timeout=1.0,
+                     margin_ms=1.0):
+    """
+    Ping all resolvable regions at the same time, in rounds of batch pings each at rate pings per
+    second, and return the one with the lowest median ping (lost pings count as infinitely slow).
+    After every round a region is dropped once the confidence interval of its median lies more than
+    margin_ms above that of another region, so clearly worse regions stop early and the close ones
+    get more pings, up to sample_size each. Of the regions left at the end, incumbent (e.g. the region
+    chosen last time) is kept when it is among them, so close calls do not flip back and forth.
+    The pings of every region are kept in all_results. Replies slower than timeout seconds, or
+    than four times the slowest median of the regions left after a round, count as lost while
+    selecting, so only their answered() pings are fit to be written or to start a main check
+    with the normal timeout.
+    """
+    candidates = []
+    for region in resolver.regions:
+        if resolver.get(region) is None:
+            print(f"Could not resolve {region}, skipping it.")
+            continue
+        candidates.append(region)
+        all_results[region] = SampleStore()
+    print(f"Pinging {', '.join(candidates)}...")
+    intervals = {}
+    default_timeout, prober.timeout = prober.timeout, min(prober.timeout, timeout)
+    try:
+        while candidates:
+            targets = {region: resolver.target(region) for region in candidates}
+            counts = {region: min(batch, sample_size - len(all_results[region])) for region in candidates}
+            probe_concurrently(prober, targets, counts, rate, sinks=all_results)
+            for region in candidates:
+                store = all_results[region]
+                intervals[region] = median_interval(
+                    [rtt / 1e6 if status == SampleStore.OK else float("inf") for rtt, status in zip(store.rtt_ns, store.status)]
+                )
+            best_high = min(intervals[region][2] for region in candidates)
+            if best_high == float("inf"):
+                break  # No region answered most of its pings, more rounds will not tell them apart
+            for region in [region for region in candidates if intervals[region][0] > best_high + margin_ms]:
+                print(f"{region} dropped after {len(all_results[region])} pings, median ping: {intervals[region][1]:.1f} ms")
+                candidates.remove(region)
+            if len(candidates) == 1 or all(len(all_results[region]) >= sample_size for region in candidates):
+                break
+            # A round lasts until its last ping is answered or lost, so stop waiting for stragglers far
+            # beyond the round trip times of the regions still in the race
+            medians = [intervals[region][1] for region in candidates if intervals[region][1] != float("inf")]
+            if medians:
+                prober.timeout = min(prober.timeout, max(4 * max(medians) / 1000, 0.1))
+    finally:
+        prober.timeout = default_timeout
+    candidates = [region for region in candidates if intervals[region][1] != float("inf")]
+    for region in candidates:
+        low, median, high = intervals[region]
+        print(f"{region} median ping: {median:.1f} ms ({low:.1f} to {high:.1f} ms) over {len(all_results[region])} pings")
+    if incumbent in candidates:
+        return incumbent
+    return min(candidates, key=lambda region: intervals[region][1], default=None)
+
+
+def region_header(region, resolver=None, backend=None):
+    lines = []
+    if backend is not None:
+        lines.append(f"Backend: {backend}")
+    if resolver is not None:
+        lines.append(f"Address: {resolver.get(region)}")
+    return lines
+
+
+def region_footer(region, resolver=None, profile=None, low_jitter=None, since=None, profile_scope=None):
+    lines = []
+    if low_jitter is not None:
+        lines.append(f"Low jitter: {', '.join(low_jitter.applied)}")
+    if resolver is not None:
+        lines += [
+            f"Address changed: {changed_at}, From: {old_address}, To: {new_address}"
+            for changed_at, _, old_address, new_address in resolver.changes_for(region, since)
+        ]
+    if profile is not None:
+        lines += profile.footer_lines(profile_scope)
+    return lines
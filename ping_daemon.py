@@ -0,0 +1,234 @@
+import argparse
+import contextlib
+import gzip
+import os
+import queue
+import shutil
+import signal
+import threading
+import time
+from datetime import datetime
+
+import ping_logs
+from ping_core import (
+    BACKENDS, REGIONS, IcmpProber, ResolverCache, clock_anchor, find_best_region, ping_server, region_footer, region_header,
+)
+from ping_logs import LOG_WRITERS, WriterProcess
+from ping_stats import PingStats
+
+SIZE_CHECK_INTERVAL = 1024  # Pings between two looks at the size of the current segment
+
+
+def log(message):
+    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {message}", flush=True)
+
+
+def resource_usage():
+    """
+    Return the resident memory in MB and the number of open file descriptors of this process,
+    each None where /proc does not tell.
+    """
+    rss_mb = fds = None
+    try:
+        with open("/proc/self/statm", 'r') as file:
+            rss_mb = int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+        fds = len(os.listdir("/proc/self/fd"))
+    except (OSError, ValueError, AttributeError):
+        pass
+    return rss_mb, fds
+
+
+class SegmentCompressor:
+    """
+    Gzip closed segments in a background thread, so the probe loop never waits on it. The
+    compressed copy is written next to the segment under a temporary name and renamed into place
+    before the segment is removed, so a crash never leaves a half-written .gz behind.
+    """
+
+    def __init__(self, backlog=64):
+        self.queue = queue.Queue(backlog)
+        self.compressed = 0
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="segment-compressor", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Compress what is still queued, then end the thread.
+        """
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, file_name):
+        self.queue.put(file_name)
+
+    def _run(self):
+        while True:
+            file_name = self.queue.get()
+            if file_name is None:
+                return
+            try:
+                self.compress(file_name)
+                self.compressed += 1
+            except OSError as e:
+                log(f"Could not compress {file_name}, keeping it as it is: {e}")
+
+    @staticmethod
+    def compress(file_name):
+        partial = f"{file_name}.gz.part"
+        with open(file_name, 'rb') as source, gzip.open(partial, 'wb') as destination:
+            shutil.copyfileobj(source, destination, 1 << 16)
+        os.replace(partial, f"{file_name}.gz")
+        os.remove(file_name)
+
+
+class SegmentWriter:
+    """
+    Sink for ping_server() that streams a region's pings into a series of results files (segments).
+    A segment is closed once it is rotate_seconds old or rotate_bytes big (0 disables a limit), and
+    then handed to the compressor, if there is one. Only the open segment and its PingStats are
+    kept, so memory and file descriptors stay flat however long it runs. With a WriterProcess the
+    segments are formatted and written by its child instead of in the probe loop.
+    """
+
+    def __init__(self, log_format="binary", compressor=None, rotate_seconds=3600, rotate_bytes=0, resolver=None,
+                 backend=None, directory=".", writer_process=None):
+        self.log_format = log_format
+        self.log_writer = LOG_WRITERS[log_format]
+        self.writer_process = writer_process
+        self.compressor = compressor
+        self.rotate_ns = int(rotate_seconds * 1e9) if rotate_seconds else None
+        self.rotate_bytes = rotate_bytes
+        self.resolver = resolver
+        self.backend = backend
+        self.directory = directory
+        self.region = None
+        self.writer = None
+        self.stats = None
+        self.segments = 0
+        self._opened_ns = 0
+        self._opened_at = None
+        self._appended = 0
+
+    def open(self, region):
+        """
+        Close the current segment, if any, and start a new one for region.
+        """
+        self.close()
+        self.region = region
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        file_name = os.path.join(self.directory, f"ping_results_{region}_{timestamp}{self.log_writer.extension}")
+        if os.path.exists(file_name) or os.path.exists(f"{file_name}.gz"):
+            file_name = os.path.join(self.directory, f"ping_results_{region}_{timestamp}_{self.segments}{self.log_writer.extension}")
+        if self.writer_process is not None:
+            self.writer = self.writer_process.writer(self.log_format, file_name, clock_anchor())
+        else:
+            self.writer = self.log_writer(file_name, clock_anchor())
+        self.writer.begin_region(region, region_header(region, self.resolver, self.backend))
+        self.stats = PingStats()
+        self.segments += 1
+        self._opened_ns = time.perf_counter_ns()
+        self._opened_at = datetime.now()
+        self._appended = 0
+
+    def close(self):
+        if self.writer is None:
+            return
+        # Only the address changes while this segment was open, the earlier ones are in earlier segments
+        self.writer.end_region(region_footer(self.region, self.resolver, since=self._opened_at))
+        self.writer.close()
+        log(f"Closed {self.writer.file_name}: {self.stats.status_line()}")
+        if self.compressor is not None:
+            self.compressor.submit(self.writer.file_name)
+        self.writer = None
+
+    def append(self, seq, send_ns, rtt_ns, status=ping_logs.OK, source=ping_logs.USER):
+        self.writer.append(seq, send_ns, rtt_ns, status, source)
+        self.stats.append(seq, send_ns, rtt_ns, status, source)
+        self._appended += 1
+        if self.rotate_ns is not None and send_ns - self._opened_ns >= self.rotate_ns:
+            self.open(self.region)
+        # The size on disk trails the pings not written yet, which is close enough for a limit in MB
+        elif self.rotate_bytes and self._appended % SIZE_CHECK_INTERVAL == 0 and os.path.getsize(self.writer.file_name) >= self.rotate_bytes:
+            self.open(self.region)
+
+
+def run(rate=10, rotate_seconds=3600, rotate_bytes=0, reselect_seconds=900, log_format="binary", compress=True,
+        sample_size=30, dns_ttl_seconds=300, backend="auto", kernel_timestamps=False, directory="."):
+    """
+    Probe the best region until SIGTERM or Ctrl+C, choosing the best region again every
+    reselect_seconds. The current region is kept unless another one is clearly better, and a change
+    of region starts a new segment. The answered selection pings of the chosen region go into the segment.
+    """
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        log(f"Received {signal.Signals(signum).name}, finishing the pings in flight")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    compressor = SegmentCompressor() if compress else None
+    with IcmpProber(kernel_timestamps=kernel_timestamps, backend=backend) as prober, \
+            ResolverCache(REGIONS, dns_ttl_seconds) as resolver, compressor or contextlib.nullcontext(), \
+            WriterProcess() as writer_process:
+        segments = SegmentWriter(log_format, compressor, rotate_seconds, rotate_bytes, resolver, prober.backend.name,
+                                 directory, writer_process)
+        log(f"Probing at {rate:g} pings per second with the {prober.backend.name} socket, "
+            f"choosing the region again every {reselect_seconds:g} seconds")
+        try:
+            while not stop.is_set():
+                selection = {}
+                best_region = find_best_region(prober, resolver, sample_size, selection, incumbent=segments.region)
+                if best_region is None:
+                    log("No region answered, trying again in a minute")
+                    stop.wait(60)
+                    continue
+                if best_region != segments.region:
+                    log(f"Best region is now {best_region}")
+                    segments.open(best_region)
+                for sample in selection[best_region].answered():  # Timeouts were shortened while selecting
+                    segments.append(*sample)
+                _, report = ping_server(prober, resolver.target(best_region), rate=rate, duration=reselect_seconds,
+                                        sink=segments, stop=stop)
+                rss_mb, fds = resource_usage()
+                log(f"{best_region}: {report}, {segments.segments} segments, "
+                    f"{f'{rss_mb:.1f} MB' if rss_mb is not None else 'unknown'} resident, "
+                    f"{fds if fds is not None else 'unknown'} open files")
+        finally:
+            segments.close()
+    log("Stopped")
+
+
+if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()  # The segments are written by a child process
+    parser = argparse.ArgumentParser(description='Probe the best region continuously, in rotating results files')
+    parser.add_argument('-r', '--rate', type=float, default=10, help='Pings per second. Default is 10.')
+    parser.add_argument('--rotate-minutes', type=float, default=60, help='Start a new results file after this many minutes, 0 for no time limit. Default is 60.')
+    parser.add_argument('--rotate-mb', type=float, default=0, help='Start a new results file once it reaches this many MB. Default 0 has no size limit.')
+    parser.add_argument('--reselect-minutes', type=float, default=15, help='Choose the best region again after this many minutes. Default is 15.')
+    parser.add_argument('-f', '--format', choices=list(LOG_WRITERS), default='binary', help='Results file format. Default is binary.')
+    parser.add_argument('--no-compress', action='store_true', help='Keep closed results files as they are instead of gzipping them.')
+    parser.add_argument('-d', '--directory', default='.', help='Folder for the results files. Default is the current folder.')
+    parser.add_argument('--dns-ttl', type=int, default=300, help='Seconds between background re-resolutions of the region hostnames. Default is 300.')
+    parser.add_argument('-k', '--kernel-timestamps', action='store_true', help='Let the kernel timestamp pings where the platform supports it (Linux).')
+    parser.add_argument('-b', '--backend', choices=['auto'] + list(BACKENDS), default='auto', help='ICMP socket to use. Default is auto.')
+    args = parser.parse_args()
+    run(rate=args.rate, rotate_seconds=args.rotate_minutes * 60, rotate_bytes=int(args.rotate_mb * 1e6),
+        reselect_seconds=args.reselect_minutes * 60, log_format=args.format, compress=not args.no_compress,
+        dns_ttl_seconds=args.dns_ttl, backend=args.backend, kernel_timestamps=args.kernel_timestamps,
+        directory=args.directory)
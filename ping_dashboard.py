@@ -0,0 +1,354 @@
+import contextlib
+import sys
+import time
+from array import array
+from collections import deque
+
+from ping_logs import OK
+from ping_stats import PERCENTILES, PingStats
+
+WINDOWS = (1, 10, 60)  # Rolling windows of the dashboard in seconds
+
+
+class SampleRing:
+    """
+    Fixed-size ring of finished pings with a single producer (the probe loop) and a single
+    consumer (the dashboard process). append() only stores three numbers and bumps a counter,
+    it never takes a lock, so the reader can not hold up the probe loop. A reader that falls a
+    full ring behind loses the oldest samples instead of blocking the writer. The slots and the
+    counter live in buffer, which the Dashboard allocates in shared memory.
+    """
+
+    def __init__(self, capacity=1 << 16, buffer=None):
+        if capacity & (capacity - 1):
+            raise ValueError("The ring capacity must be a power of two")
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self.buffer = buffer if buffer is not None else bytearray(self.size(capacity))
+        view = memoryview(self.buffer).cast('B')
+        self._written = view[:8].cast('q')  # Samples appended so far, only written by the producer
+        self.send_ns = view[8:8 + 8 * capacity].cast('q')
+        self.rtt_ns = view[8 + 8 * capacity:8 + 16 * capacity].cast('q')
+        self.status = view[8 + 16 * capacity:8 + 17 * capacity]
+
+    @staticmethod
+    def size(capacity):
+        """
+        Bytes of the buffer of a ring with capacity slots.
+        """
+        return 8 + 17 * capacity
+
+    @property
+    def written(self):
+        return self._written[0]
+
+    def append(self, seq, send_ns, rtt_ns, status=OK, source=0):
+        written = self._written[0]
+        i = written & self._mask
+        self.send_ns[i] = send_ns
+        self.rtt_ns[i] = rtt_ns
+        self.status[i] = status
+        self._written[0] = written + 1  # Publish the slot only after it is filled in
+
+    def read(self, position):
+        """
+        Return the (send_ns, rtt_ns, status) samples appended since position, the position to
+        continue from, and how many samples were overwritten before they could be read.
+        """
+        end = self.written
+        start = max(position, end - self.capacity)
+        mask = self._mask
+        samples = [(self.send_ns[i & mask], self.rtt_ns[i & mask], self.status[i & mask]) for i in range(start, end)]
+        # The producer may have wrapped around onto the first slots while they were copied
+        overwritten = self.written - self.capacity - start
+        if overwritten > 0:
+            del samples[:overwritten]
+            start += overwritten
+        return samples, end, start - position
+
+
+class WindowStats(PingStats):
+    """
+    PingStats of a rolling window, kept as a running sum of per-second PingStats: a second is
+    merged in once it is complete and taken out again with unmerge() when it falls out of the
+    window, so reading a window costs the same however many seconds it spans. Only the counts,
+    the jitter and the percentiles are kept up to date, which is what the dashboard shows.
+    """
+
+    def __init__(self, seconds, relative_accuracy=0.01):
+        super().__init__(relative_accuracy)
+        self.seconds = seconds
+        self._jitter_sum = 0.0  # Jitter of every second weighted by its count, like merge() averages it
+
+    def merge(self, other, sign=1):
+        self.count += sign * other.count
+        self.lost += sign * other.lost
+        self._jitter_sum += sign * other.jitter * other.count
+        self.jitter = self._jitter_sum / self.count if self.count else 0.0
+        buckets = self.sketch.buckets
+        for key, count in other.sketch.buckets.items():
+            count = buckets.get(key, 0) + sign * count
+            if count:
+                buckets[key] = count
+            else:
+                del buckets[key]  # Keeps the buckets to sort for the percentiles few
+        self.sketch.zeros += sign * other.sketch.zeros
+        self.sketch.count += sign * other.sketch.count
+
+    def unmerge(self, other):
+        self.merge(other, -1)
+
+    def append_late(self, rtt_ns, status, jitter_change):
+        """
+        Add a ping that arrived after its second was merged, along with the change it made to
+        that second's count weighted jitter.
+        """
+        if status == OK:
+            self.count += 1
+            self.sketch.add(rtt_ns / 1e6)
+        else:
+            self.lost += 1
+        self._jitter_sum += jitter_change
+        self.jitter = self._jitter_sum / self.count if self.count else 0.0
+
+    def percentiles(self, percentiles=PERCENTILES):
+        # Without min and max the bucket midpoints are not clamped, they are within the sketch accuracy
+        return self.sketch.quantiles([p / 100 for p in percentiles])
+
+
+class RollingStats:
+    """
+    Per-second PingStats of one target and a WindowStats for each of the rolling windows.
+    """
+
+    def __init__(self, windows=WINDOWS):
+        self.seconds = deque()  # (second, PingStats), oldest first
+        self.windows = {seconds: WindowStats(seconds) for seconds in windows}
+        self.max_window = max(windows)
+        self.merged_until = 0  # The seconds before this one are merged into the windows
+        self.total = PingStats()
+        self.dropped = 0
+        self.position = 0
+        self.first_second = None
+
+    def add(self, send_ns, rtt_ns, status):
+        # Replies count for the second they arrived in
+        second = (send_ns + max(rtt_ns, 0)) // 1000000000
+        if self.first_second is None:
+            self.first_second = second
+        if not self.seconds or second > self.seconds[-1][0]:
+            self.seconds.append((second, PingStats()))
+        # Replies can finish slightly out of order, so search back for their second
+        bucket_second, bucket = next(((bucket_second, stats) for bucket_second, stats in reversed(self.seconds)
+                                      if bucket_second <= second), self.seconds[0])
+        if bucket_second < self.merged_until:
+            # Lost pings are only known after their second is complete, the windows holding it get them too
+            weighted_jitter = bucket.jitter * bucket.count
+            bucket.append(0, send_ns, rtt_ns, status)
+            for window in self.windows.values():
+                if bucket_second >= self.merged_until - window.seconds:
+                    window.append_late(rtt_ns, status, bucket.jitter * bucket.count - weighted_jitter)
+        else:
+            bucket.append(0, send_ns, rtt_ns, status)
+        self.total.append(0, send_ns, rtt_ns, status)
+
+    def advance(self, now_second):
+        """
+        Move the windows up to, but not including, now_second: merge the seconds that completed
+        since the last call and unmerge the ones that fell out of a window.
+        """
+        if now_second <= self.merged_until:
+            return
+        for window in self.windows.values():
+            old_start, new_start = self.merged_until - window.seconds, now_second - window.seconds
+            for second, bucket in self.seconds:
+                if old_start <= second < min(new_start, self.merged_until):
+                    window.unmerge(bucket)
+                elif max(new_start, self.merged_until) <= second < now_second:
+                    window.merge(bucket)
+        self.merged_until = now_second
+        while self.seconds and self.seconds[0][0] < now_second - self.max_window:
+            self.seconds.popleft()
+
+    def window(self, seconds, now_second):
+        """
+        Return the WindowStats of the last complete seconds up to, but not including, now_second.
+        """
+        self.advance(now_second)
+        return self.windows[seconds]
+
+    def rate(self, now_second):
+        if self.first_second is None:
+            return 0.0
+        seconds = min(10, now_second - self.first_second)
+        return self.window(10, now_second).sent / seconds if seconds > 0 else 0.0
+
+
+ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
+
+
+def enable_ansi(stream):
+    """
+    Make the terminal behind stream understand ANSI escape codes and return whether it does.
+    Every terminal but the Windows console does already; that one needs virtual terminal
+    processing switched on, which consoles from before Windows 10 do not support.
+    """
+    if sys.platform != "win32":
+        return True
+    try:
+        import ctypes
+        import msvcrt
+        handle = msvcrt.get_osfhandle(stream.fileno())
+        kernel32 = ctypes.windll.kernel32
+        mode = ctypes.c_uint32()
+        if not kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+            return False
+        return bool(mode.value & ENABLE_VIRTUAL_TERMINAL_PROCESSING or
+                    kernel32.SetConsoleMode(handle, mode.value | ENABLE_VIRTUAL_TERMINAL_PROCESSING))
+    except (ImportError, AttributeError, OSError, ValueError):
+        return False
+
+
+def _serve(names, buffers, refresh, log_interval, ring_capacity, output, interactive, ready, stop):
+    """
+    Loop of the Dashboard child: draw the rings in buffers until the parent sets stop or goes away.
+    """
+    import multiprocessing
+    import signal
+
+    # Ctrl+C reaches the whole process group, the parent stops the dashboard when it is done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    dashboard = Dashboard(names, refresh, log_interval, ring_capacity, output, interactive, buffers)
+    ready.set()
+    with open(output, "w") if output is not None else contextlib.nullcontext(sys.stdout) as stream:
+        dashboard._run(stream, stop, multiprocessing.parent_process())
+
+
+class Dashboard:
+    """
+    Live terminal view of running probes: sent, received and lost counts, the achieved probe
+    rate, and p50, p99 and jitter over the last 1, 10 and 60 seconds per target.
+    A child process drains the SampleRing of every target, which lives in shared memory, and
+    redraws refresh times per second, so merging the windows and formatting them never holds the
+    GIL of the probe loop. When the output is not a terminal, or one without
+    ANSI escape codes such as an old Windows console, a plain line per target is printed every
+    log_interval seconds instead. output is a file name to draw into instead of stdout.
+    """
+
+    def __init__(self, names, refresh=0.5, log_interval=10, ring_capacity=1 << 16, output=None, interactive=None,
+                 buffers=None):
+        self.names = list(names)
+        if buffers is None:
+            import multiprocessing  # Only live runs draw a dashboard
+
+            context = multiprocessing.get_context("spawn")
+            buffers = [context.RawArray('b', SampleRing.size(ring_capacity)) for _ in self.names]
+        self.buffers = buffers
+        self.rings = {name: SampleRing(ring_capacity, buffer) for name, buffer in zip(self.names, buffers)}
+        self.rolling = {name: RollingStats() for name in self.names}
+        self.refresh = refresh
+        self.log_interval = log_interval
+        self.ring_capacity = ring_capacity
+        self.output = output
+        self.stream = sys.stdout
+        self.interactive = interactive  # None until the dashboard process has looked at its output
+        self._drawn_lines = 0
+        self._logged = time.monotonic()
+        self._stop = None
+        self._process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def ring(self, name):
+        return self.rings[name]
+
+    def start(self):
+        if self._process is None:
+            import multiprocessing
+
+            # Spawned rather than forked, the resolver thread may hold locks
+            context = multiprocessing.get_context("spawn")
+            ready = context.Event()
+            self._stop = context.Event()
+            self._process = context.Process(
+                target=_serve, name="dashboard", daemon=True,
+                args=(self.names, self.buffers, self.refresh, self.log_interval, self.ring_capacity, self.output,
+                      self.interactive, ready, self._stop))
+            sys.stdout.flush()  # What was printed so far goes before the first drawing
+            self._process.start()
+            # The child imports the modules again, which is CPU time better spent before the first ping
+            while not ready.wait(0.1) and self._process.is_alive():
+                pass
+        return self
+
+    def stop(self):
+        """
+        Stop the dashboard process, after it has drawn the final state once more.
+        """
+        if self._process is not None:
+            self._stop.set()
+            self._process.join()
+            self._process = None
+
+    def _run(self, stream, stop, parent):
+        self.stream = stream
+        if self.interactive is None:
+            self.interactive = stream.isatty() and enable_ansi(stream)
+        while not stop.wait(self.refresh) and parent.is_alive():
+            self.update()
+            if self.interactive:
+                self.draw()
+            elif time.monotonic() - self._logged >= self.log_interval:
+                self._logged = time.monotonic()
+                self.stream.write("".join(f"  {line}\n" for line in self.log_lines()))
+                self.stream.flush()
+        self.update()
+        if self.interactive:
+            self.draw()
+
+    def update(self):
+        for name, ring in self.rings.items():
+            rolling = self.rolling[name]
+            samples, rolling.position, dropped = ring.read(rolling.position)
+            rolling.dropped += dropped
+            for send_ns, rtt_ns, status in samples:
+                rolling.add(send_ns, rtt_ns, status)
+
+    def _window_text(self, stats):
+        if not stats.count:
+            return f"{'-':>7} {'-':>7} {'-':>6}"
+        p50, p99 = stats.percentiles((50, 99))
+        return f"{p50:7.2f} {p99:7.2f} {stats.jitter:6.2f}"
+
+    def lines(self):
+        now_second = time.perf_counter_ns() // 1000000000
+        width = max(len(str(name)) for name in self.rolling)
+        windows = " | ".join(f"{f'{seconds}s p50/p99/jitter':>22}" for seconds in WINDOWS)
+        lines = [f"{'':<{width}} {'sent':>8} {'recv':>8} {'lost':>6} {'rate/s':>7} | {windows}"]
+        for name, rolling in self.rolling.items():
+            total = rolling.total
+            windows = " | ".join(self._window_text(rolling.window(seconds, now_second)) for seconds in WINDOWS)
+            lines.append(f"{name:<{width}} {total.sent:8d} {total.count:8d} {total.lost:6d} "
+                         f"{rolling.rate(now_second):7.1f} | {windows}")
+        return lines
+
+    def log_lines(self):
+        now_second = time.perf_counter_ns() // 1000000000
+        lines = []
+        for name, rolling in self.rolling.items():
+            window = rolling.window(10, now_second)
+            lines.append(f"{name}: sent {rolling.total.sent}, lost {rolling.total.lost}, "
+                         f"{rolling.rate(now_second):.1f}/s, last 10s {window.status_line()}")
+        return lines
+
+    def draw(self):
+        lines = self.lines()
+        # Move up over the previous drawing and clear it before redrawing
+        prefix = f"\x1b[{self._drawn_lines}F\x1b[J" if self._drawn_lines else ""
+        self.stream.write(prefix + "\n".join(lines) + "\n")
+        self.stream.flush()
+        self._drawn_lines = len(lines)
@@ -0,0 +1,692 @@
+import json
+import mmap
+import os
+import struct
+import time
+from array import array
+from datetime import datetime, timedelta
+
+# Sample status and timestamp source values, shared with the sample store of the collector
+OK = 0
+LOST = 1
+USER = 0
+KERNEL_RX = 1
+KERNEL_TX = 2
+KERNEL = KERNEL_RX | KERNEL_TX
+SOURCE_NAMES = {USER: "user", KERNEL_RX: "kernel-rx", KERNEL_TX: "kernel-tx", KERNEL: "kernel"}
+
+# Binary format: a file header, then chunks of (tag, reserved, payload length) padded to 8 bytes.
+# HEAD, FOOT and INTR chunks hold JSON, PING chunks hold fixed-width little-endian records.
+MAGIC = b"PINGLOG\0"
+GZIP_MAGIC = b"\x1f\x8b"  # Closed daemon segments are gzipped, the readers take them as they are
+VERSION = 1
+FILE_HEADER = struct.Struct("<8sHHI")  # magic, version, record size, reserved
+CHUNK = struct.Struct("<4sIQ")
+RECORD = struct.Struct("<qqIBBxx")  # send_ns, rtt_ns, seq (modulo 2**32), status, source
+OPEN_LENGTH = 2 ** 64 - 1  # Length of a PING chunk that is still being written
+LOSS_UNKNOWN = "Loss: unknown"  # Header line of regions converted from text, which does not list lost pings
+HEADER_KEYS = ("Backend", "Address", "Loss")  # Keys of the header lines, every other line of a region is a footer line
+RECORD_FIELDS = {
+    "names": ["send_ns", "rtt_ns", "seq", "status", "source"],
+    "formats": ["<i8", "<i8", "<u4", "u1", "u1"],
+    "offsets": [0, 8, 16, 20, 21],
+    "itemsize": RECORD.size,
+}
+_numpy = False  # Not imported yet
+
+
+def load_numpy():
+    """
+    Import NumPy on first use and return it, or None when it is not installed. Only the readers
+    use it, so writing results files never pays for the import.
+    """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:  # The readers copy the columns into arrays instead
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+def wall_time(anchor, ns):
+    """
+    Convert a perf_counter nanosecond time to a wall clock datetime, using the run's
+    (time_ns, perf_counter_ns) anchor.
+    """
+    wall_ns = anchor[0] + ns - anchor[1]
+    return datetime.fromtimestamp(wall_ns // 1000000000) + timedelta(microseconds=wall_ns % 1000000000 // 1000)
+
+
+def wall_ns(moment):
+    """
+    Inverse of wall_time with a (0, 0) anchor, for timestamps read back from a text file.
+    """
+    return int(time.mktime(moment.timetuple())) * 1000000000 + moment.microsecond * 1000
+
+
+def header_fields(lines):
+    """
+    Split "Key: value" header lines such as "Backend: raw" into a dict.
+    """
+    fields = {}
+    for line in lines:
+        key, _, value = line.partition(": ")
+        fields[key] = value
+    return fields
+
+
+def _padding(length):
+    return -length % 8
+
+
+class LogWriter:
+    """
+    Stream pings to a results file as they complete, instead of holding the whole run in memory.
+    Samples are encoded in batches, and the file is flushed and fsynced every flush_interval
+    seconds, so a cancelled run still leaves a usable file with a footer. A flush_interval of None
+    only flushes on close, for files that are written in one go such as conversions.
+    """
+
+    mode = 'w'
+    extension = ""
+
+    def __init__(self, file_name, anchor, flush_interval=5, batch_size=1024):
+        self.file_name = file_name
+        self.anchor = anchor
+        self.flush_interval_ns = int(flush_interval * 1e9) if flush_interval is not None else None
+        self.batch_size = batch_size
+        self.file = open(file_name, self.mode, buffering=1 << 16)
+        self.in_region = False
+        self.written = 0
+        self._flushed_ns = time.perf_counter_ns()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(interrupted=exc_type is KeyboardInterrupt)
+
+    def begin_region(self, region, header_lines=()):
+        if self.in_region:
+            self.end_region()
+        self._begin_region(region, header_lines)
+        self.in_region = True
+
+    def append(self, seq, send_ns, rtt_ns, status=OK, source=USER):
+        if self._add(seq, send_ns, rtt_ns, status, source) >= self.batch_size:
+            self._write_pending()
+        # Samples can carry another clock than this writer's (a converted file's wall clock), so the
+        # interval is measured on perf_counter at append time
+        if self.flush_interval_ns is not None and time.perf_counter_ns() - self._flushed_ns > self.flush_interval_ns:
+            self.flush()
+
+    def end_region(self, footer_lines=()):
+        self._write_pending()
+        self._end_region(footer_lines)
+        self.in_region = False
+
+    def write_region(self, region, store, header_lines=(), footer_lines=()):
+        """
+        Write a complete region block from a sample store in send order.
+        """
+        anchor, self.anchor = self.anchor, store.anchor
+        self.begin_region(region, header_lines)
+        for seq, send_ns, rtt_ns, status, source in store.samples():
+            self.append(seq, send_ns, rtt_ns, status, source)
+        self.end_region(footer_lines)
+        self.anchor = anchor
+
+    def flush(self):
+        self._write_pending()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._flushed_ns = time.perf_counter_ns()
+
+    def close(self, interrupted=False, interrupted_at=None):
+        if self.file.closed:
+            return
+        if self.in_region:
+            self.end_region()
+        if interrupted:
+            self._write_interrupted(interrupted_at or datetime.now())
+        self.flush()
+        self.file.close()
+
+
+class TextLogWriter(LogWriter):
+    """
+    Write the text format: a "Region:" line, header lines, one "Sent: ..., Received: ..." line
+    per answered ping, footer lines and a blank line.
+    """
+
+    extension = ".txt"
+
+    def __init__(self, file_name, anchor, flush_interval=5, batch_size=1024):
+        self.pending = array('q')  # send_ns, rtt_ns pairs that are not formatted yet
+        self.sources = {}
+        super().__init__(file_name, anchor, flush_interval, batch_size)
+
+    def _begin_region(self, region, header_lines):
+        self.file.write(f"Region: {region}\n")
+        for line in header_lines:
+            self.file.write(f"{line}\n")
+        self.sources = {}
+
+    def _add(self, seq, send_ns, rtt_ns, status, source):
+        if status == OK:  # The text format only lists answered pings
+            self.pending.append(send_ns)
+            self.pending.append(rtt_ns)
+            self.sources[source] = self.sources.get(source, 0) + 1
+        return len(self.pending) // 2
+
+    def _write_pending(self):
+        anchor = self.anchor
+        pending = self.pending
+        self.file.write("".join(
+            f"Sent: {wall_time(anchor, pending[i])}, Received: {wall_time(anchor, pending[i] + pending[i + 1])}\n"
+            for i in range(0, len(pending), 2)
+        ))
+        self.written += len(pending) // 2
+        del pending[:]
+
+    def _end_region(self, footer_lines):
+        for line in footer_lines:
+            self.file.write(f"{line}\n")
+        sources = ", ".join(f"{SOURCE_NAMES[source]}={count}" for source, count in sorted(self.sources.items()))
+        self.file.write(f"Timestamps: {sources or 'none'}\n\n")
+
+    def _write_interrupted(self, interrupted_at):
+        self.file.write(f"Interrupted: {interrupted_at}, Pings written: {self.written}\n")
+
+
+class BinaryLogWriter(LogWriter):
+    """
+    Write the binary format: 24 byte records instead of ~70 byte text lines, keeping lost pings,
+    the raw perf_counter times and the clock anchor of every region.
+    """
+
+    mode = 'wb'
+    extension = ".bin"
+
+    def __init__(self, file_name, anchor, flush_interval=5, batch_size=1024):
+        self.pending = bytearray()
+        self._length_offset = None  # Where the length of the open PING chunk goes
+        self._records = 0
+        super().__init__(file_name, anchor, flush_interval, batch_size)
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, RECORD.size, 0))
+
+    def _write_chunk(self, tag, payload, length=None):
+        self.file.write(CHUNK.pack(tag, 0, len(payload) if length is None else length))
+        self.file.write(payload)
+        self.file.write(bytes(_padding(len(payload))))
+
+    def _write_json(self, tag, value):
+        self._write_chunk(tag, json.dumps(value).encode())
+
+    def _begin_region(self, region, header_lines):
+        fields = header_fields(header_lines)
+        self._write_json(b"HEAD", {
+            "region": region,
+            "address": fields.get("Address"),
+            "backend": fields.get("Backend"),
+            "anchor": list(self.anchor),
+            "header": list(header_lines),
+        })
+        self._length_offset = self.file.tell() + 8
+        self._write_chunk(b"PING", b"", OPEN_LENGTH)
+        self._records = 0
+
+    def _add(self, seq, send_ns, rtt_ns, status, source):
+        self.pending += RECORD.pack(send_ns, rtt_ns, seq & 0xFFFFFFFF, status, source)
+        return len(self.pending) // RECORD.size
+
+    def _write_pending(self):
+        self.file.write(self.pending)
+        self.written += len(self.pending) // RECORD.size
+        self._records += len(self.pending) // RECORD.size
+        del self.pending[:]
+
+    def _end_region(self, footer_lines):
+        # The records are a multiple of 8 bytes, so the chunk needs no padding
+        end = self.file.tell()
+        self.file.seek(self._length_offset)
+        self.file.write(struct.pack("<Q", self._records * RECORD.size))
+        self.file.seek(end)
+        self._write_json(b"FOOT", {"footer": list(footer_lines)})
+
+    def _write_interrupted(self, interrupted_at):
+        self._write_json(b"INTR", {"time": str(interrupted_at), "written": self.written})
+
+
+LOG_WRITERS = {"text": TextLogWriter, "binary": BinaryLogWriter}
+
+
+def _serve(requests, replies):
+    """
+    Loop of the WriterProcess child: apply the requests of its BackgroundWriters to real LogWriters
+    until the parent says stop. Files still open when the parent goes away without stopping are
+    closed as interrupted.
+    """
+    import multiprocessing
+    import queue
+    import signal
+
+    # Ctrl+C and SIGTERM reach the whole process group, the parent decides when the files are done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    parent = multiprocessing.parent_process()
+    writers = {}
+    errors = {}  # Key -> first error of a writer, raised in the parent when it opens or closes the file
+    while True:
+        try:
+            request = requests.get(timeout=1)
+        except queue.Empty:
+            if parent.is_alive():
+                continue
+            break
+        if request is None:
+            break
+        action, key, args = request
+        try:
+            if key in errors:
+                pass
+            elif action == "open":
+                log_format, file_name, anchor, flush_interval, batch_size = args
+                writers[key] = LOG_WRITERS[log_format](file_name, anchor, flush_interval, batch_size)
+            elif action == "append":
+                append = writers[key].append
+                for send_ns, rtt_ns, seq, status, source in RECORD.iter_unpack(args):
+                    append(seq, send_ns, rtt_ns, status, source)
+            elif action == "begin":
+                writers[key].begin_region(*args)
+            elif action == "end":
+                writers[key].end_region(args)
+            elif action == "flush":
+                writers[key].flush()
+            elif action == "close":
+                writers[key].close(*args)
+        except Exception as e:
+            errors[key] = e
+        if action == "open":
+            replies.send((errors.pop(key, None), 0))
+        elif action == "close":
+            writer = writers.pop(key, None)
+            replies.send((errors.pop(key, None), writer.written if writer is not None else 0))
+    for writer in writers.values():
+        writer.close(interrupted=True)
+
+
+class WriterProcess:
+    """
+    Child process that owns the results files of a run, so formatting the samples and fsyncing
+    the files cost the probe loop nothing: a LogWriter does both in append(), which holds up the
+    replies that arrive meanwhile. writer() returns a BackgroundWriter for it. Requests go through
+    a multiprocessing queue, whose feeder thread does the pipe writes, so handing over a batch
+    never waits for the child either. The child is only started with the first writer, and stop()
+    waits until it has closed every file.
+    """
+
+    def __init__(self):
+        self._process = None
+        self._requests = None
+        self._replies = None
+        self._keys = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self._process is None:
+            import multiprocessing  # Only live runs write through a child process, conversions do not
+
+            # Spawned rather than forked, the resolver thread may hold locks
+            context = multiprocessing.get_context("spawn")
+            self._requests = context.Queue()
+            self._replies, replies = context.Pipe(duplex=False)
+            self._process = context.Process(target=_serve, args=(self._requests, replies), name="log-writer",
+                                            daemon=True)
+            self._process.start()
+            replies.close()
+        return self
+
+    def stop(self):
+        if self._process is None:
+            return
+        self._requests.put(None)  # The child closes what is still open and exits
+        self._requests.close()
+        self._requests.join_thread()
+        self._process.join()
+        self._replies.close()
+        self._process = None
+
+    def request(self, action, key, args=None):
+        self._requests.put((action, key, args))
+
+    def wait(self):
+        try:
+            error, written = self._replies.recv()
+        except EOFError:
+            raise OSError("The log writer process ended") from None
+        if error is not None:
+            raise error
+        return written
+
+    def writer(self, log_format, file_name, anchor, flush_interval=5, batch_size=1024):
+        self.start()
+        self._keys += 1
+        return BackgroundWriter(self, self._keys, log_format, file_name, anchor, flush_interval, batch_size)
+
+
+class BackgroundWriter:
+    """
+    LogWriter stand-in whose file is written by a WriterProcess. append() only packs the sample
+    into a RECORD, and full batches (or the samples of the last flush_interval seconds) go to the
+    child in one pipe write. Opening and closing the file wait for the child, so errors are raised
+    here like with a LogWriter, and a closed file is complete.
+    """
+
+    def __init__(self, process, key, log_format, file_name, anchor, flush_interval=5, batch_size=1024):
+        self.process = process
+        self.key = key
+        self.file_name = file_name
+        self.anchor = anchor
+        self.extension = LOG_WRITERS[log_format].extension
+        self.flush_interval_ns = int(flush_interval * 1e9) if flush_interval is not None else None
+        self.batch_size = batch_size * RECORD.size
+        self.pending = bytearray()
+        self.in_region = False
+        self.written = 0  # Known once the file is closed
+        self.closed = False
+        self._handed_ns = time.perf_counter_ns()
+        process.request("open", key, (log_format, file_name, anchor, flush_interval, batch_size))
+        process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(interrupted=exc_type is KeyboardInterrupt)
+
+    def _hand_over(self):
+        if self.pending:
+            self.process.request("append", self.key, bytes(self.pending))
+            del self.pending[:]
+        self._handed_ns = time.perf_counter_ns()
+
+    def begin_region(self, region, header_lines=()):
+        self._hand_over()
+        self.process.request("begin", self.key, (region, list(header_lines)))
+        self.in_region = True
+
+    def append(self, seq, send_ns, rtt_ns, status=OK, source=USER):
+        self.pending += RECORD.pack(send_ns, rtt_ns, seq & 0xFFFFFFFF, status, source)
+        if len(self.pending) >= self.batch_size or (
+                self.flush_interval_ns is not None and time.perf_counter_ns() - self._handed_ns > self.flush_interval_ns):
+            self._hand_over()
+
+    def end_region(self, footer_lines=()):
+        self._hand_over()
+        self.process.request("end", self.key, list(footer_lines))
+        self.in_region = False
+
+    def flush(self):
+        self._hand_over()
+        self.process.request("flush", self.key)
+
+    def close(self, interrupted=False, interrupted_at=None):
+        if self.closed:
+            return
+        self._hand_over()
+        self.in_region = False
+        if interrupted and interrupted_at is None:
+            interrupted_at = datetime.now()
+        self.process.request("close", self.key, (interrupted, interrupted_at))
+        self.closed = True
+        self.written = self.process.wait()
+
+
+class LogRegion:
+    """
+    One region block read back from a results file. The seq, send_ns, rtt_ns, status and source
+    columns are NumPy arrays when NumPy is installed, array.array otherwise. Times are perf_counter
+    nanoseconds relative to the anchor, rtt_ns is -1 for lost pings.
+    """
+
+    def __init__(self, region, header_lines, anchor, columns):
+        self.region = region
+        self.header_lines = header_lines
+        self.footer_lines = []
+        self.anchor = anchor
+        self.seq, self.send_ns, self.rtt_ns, self.status, self.source = columns
+
+    def __len__(self):
+        return len(self.send_ns)
+
+    @property
+    def fields(self):
+        return header_fields(self.header_lines)
+
+    @property
+    def address(self):
+        return self.fields.get("Address")
+
+    @property
+    def backend(self):
+        return self.fields.get("Backend")
+
+    def wall_time(self, ns):
+        return wall_time(self.anchor, ns)
+
+    def samples(self):
+        """
+        Yield (seq, send_ns, rtt_ns, status, source) tuples in send order, like SampleStore.samples.
+        """
+        numpy = load_numpy()
+        if numpy is not None:
+            order = numpy.argsort(self.send_ns, kind="stable")
+        else:
+            order = sorted(range(len(self.send_ns)), key=self.send_ns.__getitem__)
+        for i in order:
+            yield int(self.seq[i]), int(self.send_ns[i]), int(self.rtt_ns[i]), int(self.status[i]), int(self.source[i])
+
+
+class PingLog:
+    """
+    The regions of a results file, plus when the run was interrupted if it was.
+    """
+
+    def __init__(self, file_name, log_format, regions, interrupted_at=None):
+        self.file_name = file_name
+        self.format = log_format
+        self.regions = regions
+        self.interrupted_at = interrupted_at
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def __len__(self):
+        return len(self.regions)
+
+
+def _columns(seq, send_ns, rtt_ns, status, source):
+    numpy = load_numpy()
+    if numpy is None:
+        return seq, send_ns, rtt_ns, status, source
+    # Views on the arrays' buffers, no copy
+    return (numpy.frombuffer(seq, numpy.int64), numpy.frombuffer(send_ns, numpy.int64),
+            numpy.frombuffer(rtt_ns, numpy.int64), numpy.frombuffer(status, numpy.uint8),
+            numpy.frombuffer(source, numpy.uint8))
+
+
+def is_gzip(file_name):
+    with open(file_name, 'rb') as file:
+        return file.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+def open_log(file_name, mode='rb'):
+    """
+    Open a results file for reading ('rb' or 'r'), decompressing it on the fly when it is gzipped.
+    """
+    if is_gzip(file_name):
+        import gzip  # Only the readers of compressed segments need it
+        return gzip.open(file_name, mode if 'b' in mode else 'rt')
+    return open(file_name, mode)
+
+
+def read_text_log(file_name):
+    """
+    Parse a text results file, including the ones written before the binary format existed.
+    The samples get a (0, 0) anchor, so their send_ns are wall clock nanoseconds.
+    """
+    source_ids = {name: source for source, name in SOURCE_NAMES.items()}
+    regions = []
+    interrupted_at = None
+    region = None
+
+    def finish(region, columns, footer_lines):
+        sources = header_fields(line for line in footer_lines if line.startswith("Timestamps: "))
+        footer_lines[:] = [line for line in footer_lines if not line.startswith("Timestamps: ")]
+        counts = dict(part.split("=") for part in sources.get("Timestamps", "").split(", ") if "=" in part)
+        if len(counts) == 1 and next(iter(counts)) in source_ids:
+            # Only the counts per source are known, so a source is only kept when it was the only one
+            columns = columns[:4] + (array('B', [source_ids[next(iter(counts))]]) * len(columns[0]),)
+        result = LogRegion(region, header_lines, (0, 0), _columns(*columns))
+        result.footer_lines = footer_lines
+        regions.append(result)
+
+    with open_log(file_name, 'r') as file:
+        for line in file:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            key, _, value = line.partition(": ")
+            if key == "Region":
+                if region is not None:
+                    finish(region, columns, footer_lines)
+                region = value
+                header_lines = []
+                footer_lines = []
+                columns = (array('q'), array('q'), array('q'), array('B'), array('B'))
+            elif key == "Interrupted":
+                interrupted_at = datetime.fromisoformat(value.partition(", ")[0])
+            elif region is None:
+                continue
+            elif key == "Sent":
+                sent, _, received = value.partition(", Received: ")
+                send_ns = wall_ns(datetime.fromisoformat(sent))
+                columns[0].append(len(columns[0]))
+                columns[1].append(send_ns)
+                columns[2].append(wall_ns(datetime.fromisoformat(received)) - send_ns)
+                columns[3].append(OK)
+                columns[4].append(USER)
+            elif key in HEADER_KEYS and not footer_lines:
+                header_lines.append(line)
+            else:
+                footer_lines.append(line)
+    if region is not None:
+        finish(region, columns, footer_lines)
+    return PingLog(file_name, "text", regions, interrupted_at)
+
+
+def read_binary_log(file_name):
+    """
+    Memory-map a binary results file. With NumPy the region columns are views on the mapping,
+    so nothing is copied until they are used. A gzipped file is decompressed into memory instead.
+    """
+    if is_gzip(file_name):
+        with open_log(file_name) as file:
+            data = file.read()
+        size = len(data)
+    else:
+        with open(file_name, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+    if size < FILE_HEADER.size:
+        raise ValueError(f"{file_name} is not a binary ping log")
+    magic, version, record_size, _ = FILE_HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError(f"{file_name} is not a version {VERSION} binary ping log")
+
+    numpy = load_numpy()
+    regions = []
+    interrupted_at = None
+    offset = FILE_HEADER.size
+    while offset + CHUNK.size <= size:
+        tag, _, length = CHUNK.unpack_from(data, offset)
+        offset += CHUNK.size
+        if length != OPEN_LENGTH and offset + length > size:
+            break  # Cut off while the chunk was written
+        if length == OPEN_LENGTH:
+            # The run stopped before the region was finished, keep the complete records
+            length = (size - offset) // RECORD.size * RECORD.size
+        if tag == b"PING":
+            count = length // RECORD.size
+            if numpy is not None:
+                records = numpy.frombuffer(data, numpy.dtype(RECORD_FIELDS), count, offset)
+                columns = (records["seq"], records["send_ns"], records["rtt_ns"], records["status"], records["source"])
+            else:
+                columns = (array('q'), array('q'), array('q'), array('B'), array('B'))
+                for send_ns, rtt_ns, seq, status, source in RECORD.iter_unpack(data[offset:offset + length]):
+                    for column, value in zip(columns, (seq, send_ns, rtt_ns, status, source)):
+                        column.append(value)
+            regions[-1].seq, regions[-1].send_ns, regions[-1].rtt_ns, regions[-1].status, regions[-1].source = columns
+        elif tag in (b"HEAD", b"FOOT", b"INTR"):
+            value = json.loads(data[offset:offset + length])
+            if tag == b"HEAD":
+                empty = (array('q'), array('q'), array('q'), array('B'), array('B'))
+                regions.append(LogRegion(value["region"], value["header"], tuple(value["anchor"]), _columns(*empty)))
+            elif tag == b"FOOT":
+                regions[-1].footer_lines = value["footer"]
+            else:
+                interrupted_at = datetime.fromisoformat(value["time"])
+        offset += length + _padding(length)
+    if numpy is None and isinstance(data, mmap.mmap):
+        data.close()
+    return PingLog(file_name, "binary", regions, interrupted_at)
+
+
+def read_log(file_name):
+    """
+    Read a results file in either format, gzipped or not.
+    """
+    with open_log(file_name) as file:
+        binary = file.read(len(MAGIC)) == MAGIC
+    return read_binary_log(file_name) if binary else read_text_log(file_name)
+
+
+def convert_log(source, destination, log_format=None):
+    """
+    Rewrite a results file in log_format, by default the format it is not in.
+    Converting to text drops the lost pings, since the text format does not list them, and a
+    binary file converted from text gets a LOSS_UNKNOWN header line in every region.
+    Return the destination file name.
+    """
+    log = read_log(source)
+    if log_format is None:
+        log_format = "text" if log.format == "binary" else "binary"
+    # Written in one go, so a single flush and fsync on close is enough
+    writer = LOG_WRITERS[log_format](destination, (0, 0), flush_interval=None)
+    for region in log:
+        header_lines = list(region.header_lines)
+        if log.format == "text" and log_format == "binary" and LOSS_UNKNOWN not in header_lines:
+            header_lines.append(LOSS_UNKNOWN)
+        writer.write_region(region.region, region, header_lines, region.footer_lines)
+    writer.close(interrupted=log.interrupted_at is not None, interrupted_at=log.interrupted_at)
+    return destination
+
+
+if __name__ == "__main__":
+    import argparse  # Only the command line needs it, not the collector importing this module
+
+    parser = argparse.ArgumentParser(description='Convert ping result files between the text and binary formats')
+    parser.add_argument('source', help='Results file to read, in either format.')
+    parser.add_argument('destination', help='File to write.')
+    parser.add_argument('-f', '--format', choices=list(LOG_WRITERS), help='Format to write. Default is the format the source is not in.')
+    args = parser.parse_args()
+    convert_log(args.source, args.destination, args.format)
@@ -0,0 +1,154 @@
+import glob
+import os
+import re
+import sqlite3
+from datetime import datetime, timedelta
+
+REGISTRY_FILE = 'ping_runs.sqlite3'
+SCHEMA_VERSION = 1
+LEGACY_NAME = re.compile(r"ping_results_(?:(.+)_)?(\d{8}_\d{6})\.(txt|bin)$")
+
+# Upload status of a run
+PENDING = "pending"  # Still running, or finished without an upload decision
+SENT = "sent"
+QUEUED = "queued"  # The upload failed, the next run retries it
+SKIPPED = "skipped"  # Not sent because of the hourly limit
+REJECTED = "rejected"  # The server answered the upload with an error, it is not retried
+CANCELLED = "cancelled"
+MISSING = "missing"  # The log file was deleted before it could be sent
+UNKNOWN = "unknown"  # Log files from before the registry existed
+
+
+class RunRegistry:
+    """
+    Local SQLite index of the runs: start time, region, sample counts, file path and upload
+    status. The hourly upload limit, the upload queue and the run history are indexed lookups,
+    so they stay fast however many log files pile up in the folder.
+    It also serves as the queue of a ping_upload.Uploader.
+    """
+
+    def __init__(self, file_name=REGISTRY_FILE):
+        self.file_name = file_name
+        new = not os.path.exists(file_name)
+        self.db = sqlite3.connect(file_name)
+        self.db.row_factory = sqlite3.Row
+        self._create()
+        if new:
+            self.import_legacy(os.path.dirname(os.path.abspath(file_name)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def _create(self):
+        with self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY,
+                    started_at TEXT NOT NULL,
+                    region TEXT,
+                    file_path TEXT NOT NULL UNIQUE,
+                    log_format TEXT,
+                    sent INTEGER,
+                    received INTEGER,
+                    upload_status TEXT NOT NULL,
+                    uploaded_at TEXT
+                );
+                CREATE INDEX IF NOT EXISTS runs_started_at ON runs (started_at);
+                CREATE INDEX IF NOT EXISTS runs_upload_status ON runs (upload_status, started_at);
+            """)
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def import_legacy(self, directory):
+        """
+        Register the log files written before the registry existed, once, so the hourly limit
+        still sees them. Their upload status is unknown.
+        """
+        rows = []
+        for path in glob.glob(os.path.join(directory, "ping_results_*")):
+            match = LEGACY_NAME.search(os.path.basename(path))
+            if match:
+                started_at = datetime.strptime(match.group(2), "%Y%m%d_%H%M%S")
+                log_format = "binary" if match.group(3) == "bin" else "text"
+                rows.append((str(started_at), match.group(1), os.path.abspath(path), log_format, UNKNOWN))
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO runs (started_at, region, file_path, log_format, upload_status) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def add_run(self, started_at, region, file_path, log_format="text"):
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT OR REPLACE INTO runs (started_at, region, file_path, log_format, upload_status) VALUES (?, ?, ?, ?, ?)",
+                (str(started_at.replace(microsecond=0)), region, os.path.abspath(file_path), log_format, PENDING),
+            )
+        return cursor.lastrowid
+
+    def finish_run(self, file_path, sent, received):
+        with self.db:
+            self.db.execute("UPDATE runs SET sent = ?, received = ? WHERE file_path = ?",
+                            (sent, received, os.path.abspath(file_path)))
+
+    def set_upload_status(self, file_path, status):
+        uploaded_at = str(datetime.now().replace(microsecond=0)) if status == SENT else None
+        with self.db:
+            self.db.execute("UPDATE runs SET upload_status = ?, uploaded_at = COALESCE(?, uploaded_at) WHERE file_path = ?",
+                            (status, uploaded_at, os.path.abspath(file_path)))
+
+    def uploaded_in_hour(self, moment):
+        """
+        Whether a run that started in the same hour of the same day was sent (or may have been,
+        for log files from before the registry).
+        """
+        hour = moment.replace(minute=0, second=0, microsecond=0)
+        row = self.db.execute(
+            "SELECT 1 FROM runs WHERE started_at >= ? AND started_at < ? AND upload_status IN (?, ?) LIMIT 1",
+            (str(hour), str(hour + timedelta(hours=1)), SENT, UNKNOWN),
+        ).fetchone()
+        return row is not None
+
+    def history(self, limit=20, status=None):
+        query = "SELECT * FROM runs"
+        parameters = ()
+        if status is not None:
+            query += " WHERE upload_status = ?"
+            parameters = (status,)
+        return self.db.execute(query + " ORDER BY started_at DESC LIMIT ?", parameters + (limit,)).fetchall()
+
+    # Upload queue interface of ping_upload.Uploader
+
+    def queued(self):
+        rows = self.db.execute("SELECT file_path FROM runs WHERE upload_status = ? ORDER BY started_at", (QUEUED,))
+        return [row["file_path"] for row in rows]
+
+    def add(self, file_path):
+        if self.db.execute("SELECT 1 FROM runs WHERE file_path = ?", (os.path.abspath(file_path),)).fetchone() is None:
+            self.add_run(datetime.now(), None, file_path)
+        self.set_upload_status(file_path, QUEUED)
+
+    def remove(self, file_path):
+        self.set_upload_status(file_path, SENT if os.path.exists(file_path) else MISSING)
+
+    def reject(self, file_path):
+        self.set_upload_status(file_path, REJECTED)
+
+
+if __name__ == "__main__":
+    import argparse  # Only the command line needs it, not the collector importing this module
+
+    parser = argparse.ArgumentParser(description='Show the runs recorded in the local run registry')
+    parser.add_argument('-n', '--limit', type=int, default=20, help='Number of runs to show, newest first. Default is 20.')
+    parser.add_argument('-s', '--status', choices=[PENDING, SENT, QUEUED, SKIPPED, REJECTED, CANCELLED, MISSING, UNKNOWN], help='Only show runs with this upload status.')
+    parser.add_argument('--registry', default=REGISTRY_FILE, help=f'Registry file. Default is {REGISTRY_FILE}.')
+    args = parser.parse_args()
+    with RunRegistry(args.registry) as registry:
+        for run in registry.history(args.limit, args.status):
+            samples = f"{run['received']}/{run['sent']} pings" if run['sent'] is not None else "no pings recorded"
+            print(f"{run['started_at']}  {run['region'] or '-':<10}  {run['upload_status']:<9}  {samples:<18}  {run['file_path']}")
@@ -0,0 +1,157 @@
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import ping_logs
+
+BATCH_SIZE = 1 << 20  # Trials drawn at a time, bounds the memory of a worker
+
+
+class LagDistribution:
+    """
+    Input lag of a controller or mouse in milliseconds, parsed from a spec:
+    "8" or "constant:8", "uniform:LOW:HIGH", "normal:MEAN:SD" (cut off at 0) or "exponential:MEAN".
+    """
+
+    KINDS = {"constant": 1, "uniform": 2, "normal": 2, "exponential": 1}
+
+    def __init__(self, spec="0"):
+        parts = str(spec).split(":")
+        if len(parts) == 1:
+            parts = ["constant"] + parts
+        self.kind, self.params = parts[0], [float(part) for part in parts[1:]]
+        if self.KINDS.get(self.kind) != len(self.params):
+            raise ValueError(f"Bad input lag {spec!r}, use a number, uniform:LOW:HIGH, normal:MEAN:SD or exponential:MEAN")
+        self.spec = spec
+
+    def __str__(self):
+        return str(self.spec)
+
+    def sample(self, rng, size):
+        if self.kind == "constant":
+            return np.full(size, self.params[0])
+        if self.kind == "uniform":
+            return rng.uniform(self.params[0], self.params[1], size)
+        if self.kind == "normal":
+            return np.maximum(rng.normal(self.params[0], self.params[1], size), 0)
+        return rng.exponential(self.params[0], size)
+
+
+def load_trace(file_name, region=None):
+    """
+    Return the round trip times in milliseconds of the answered pings of a results file,
+    in either format, for one region or all of them.
+    """
+    traces = [
+        np.asarray(block.rtt_ns, np.int64)[np.asarray(block.status) == ping_logs.OK] / 1e6
+        for block in ping_logs.read_log(file_name)
+        if region is None or block.region == region
+    ]
+    trace = np.concatenate(traces) if traces else np.zeros(0)
+    if not len(trace):
+        raise ValueError(f"No answered pings for {region or 'any region'} in {file_name}")
+    return trace
+
+
+def duel(rng, trace_a, trace_b, lag_a, lag_b, delta_ms, trials, tick_ms=0):
+    """
+    Let two players fire at the same moment in trials duels and return how many player A wins.
+    A shot reaches the server after the player's input lag plus half a round trip drawn from
+    their trace, player A having delta_ms of extra input lag. With a server tick, shots are only
+    processed at the next tick, at a random phase per duel. Ties are split by a coin flip.
+    """
+    arrival_a = trace_a[rng.integers(len(trace_a), size=trials)] / 2 + lag_a.sample(rng, trials) + delta_ms
+    arrival_b = trace_b[rng.integers(len(trace_b), size=trials)] / 2 + lag_b.sample(rng, trials)
+    if tick_ms:
+        phase = rng.uniform(0, tick_ms, trials)
+        arrival_a = np.ceil((arrival_a + phase) / tick_ms)
+        arrival_b = np.ceil((arrival_b + phase) / tick_ms)
+    ties = np.count_nonzero(arrival_a == arrival_b)
+    return np.count_nonzero(arrival_a < arrival_b) + rng.binomial(ties, 0.5)
+
+
+def _curve_chunk(task):
+    seed, trace_a, trace_b, lag_a, lag_b, deltas, trials, tick_ms = task
+    rng = np.random.default_rng(seed)
+    wins = np.zeros(len(deltas), np.int64)
+    for i, delta_ms in enumerate(deltas):
+        for start in range(0, trials, BATCH_SIZE):
+            wins[i] += duel(rng, trace_a, trace_b, lag_a, lag_b, delta_ms, min(BATCH_SIZE, trials - start), tick_ms)
+    return wins
+
+
+def win_curve(trace_a, trace_b, lag_a, lag_b, deltas, trials, tick_ms=0, workers=1, seed=None):
+    """
+    Return player A's win probability for every input lag delta in deltas, each from trials
+    duels. With more than one worker the trials are split over a process pool, every chunk
+    with its own independent random stream.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    chunks = [trials // workers + (i < trials % workers) for i in range(workers)]
+    tasks = [(seeds[i], trace_a, trace_b, lag_a, lag_b, list(deltas), chunks[i], tick_ms) for i in range(workers)]
+    if workers == 1:
+        wins = _curve_chunk(tasks[0])
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            wins = sum(pool.map(_curve_chunk, tasks))
+    return wins / trials
+
+
+def parse_range(text):
+    """
+    Turn "START:STOP:STEP" (STOP included) or a single number into a list of deltas.
+    """
+    parts = [float(part) for part in text.split(":")]
+    if len(parts) == 1:
+        return parts
+    start, stop, step = parts if len(parts) == 3 else parts + [1.0]
+    return list(np.round(np.arange(start, stop + step / 2, step), 6))
+
+
+def main(log_a, log_b=None, region=None, lag_a="0", lag_b="0", deltas="-20:20:2", trials=1000000,
+         tick_rate=0, workers=1, seed=None, csv_file=None):
+    trace_a = load_trace(log_a, region)
+    trace_b = load_trace(log_b, region) if log_b else trace_a
+    lag_a, lag_b = LagDistribution(lag_a), LagDistribution(lag_b)
+    deltas = parse_range(deltas)
+    tick_ms = 1000.0 / tick_rate if tick_rate else 0
+
+    print(f"Player A: {len(trace_a)} pings, median {np.median(trace_a):.2f} ms, input lag {lag_a} ms")
+    print(f"Player B: {len(trace_b)} pings, median {np.median(trace_b):.2f} ms, input lag {lag_b} ms")
+    if tick_ms:
+        print(f"Server tick: {tick_rate:g} Hz ({tick_ms:.2f} ms)")
+    start = time.perf_counter()
+    curve = win_curve(trace_a, trace_b, lag_a, lag_b, deltas, trials, tick_ms, workers, seed)
+    elapsed = time.perf_counter() - start
+    print(f"{trials * len(deltas)} duels in {elapsed:.2f} seconds ({trials * len(deltas) / elapsed / 1e6:.1f} million per second)\n")
+
+    print("Extra input lag of A (ms)  A wins")
+    for delta_ms, probability in zip(deltas, curve):
+        print(f"{delta_ms:>25g}  {100 * probability:5.1f}%  {'#' * int(round(probability * 40))}")
+    if csv_file is not None:
+        with open(csv_file, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(["delta_ms", "win_probability"])
+            writer.writerows(zip(deltas, curve))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulate duels between two players from collected ping logs')
+    parser.add_argument('log_a', help='Results file with the pings of player A.')
+    parser.add_argument('log_b', nargs='?', help='Results file with the pings of player B. Default is the file of player A.')
+    parser.add_argument('--region', help='Only use the pings to this region. Default is every region in the file.')
+    parser.add_argument('--lag-a', default='0', help='Input lag of player A in ms: a number, uniform:LOW:HIGH, normal:MEAN:SD or exponential:MEAN. Default is 0.')
+    parser.add_argument('--lag-b', default='0', help='Input lag of player B, same format. Default is 0.')
+    parser.add_argument('-d', '--deltas', default='-20:20:2', help='Extra input lag of player A to sweep in ms, as START:STOP:STEP, e.g. -d=-10:10:1. Default is -20:20:2.')
+    parser.add_argument('-n', '--trials', type=int, default=1000000, help='Duels per delta. Default is 1000000.')
+    parser.add_argument('--tick-rate', type=float, default=0, help='Server tick rate in Hz, shots are only processed on ticks. Default 0 processes them on arrival.')
+    parser.add_argument('-j', '--workers', type=int, default=1, help=f'Processes to spread the duels over, up to {os.cpu_count()} here. Default is 1.')
+    parser.add_argument('--seed', type=int, help='Random seed, for repeatable results.')
+    parser.add_argument('--csv', help='Also write the curve to this CSV file.')
+    args = parser.parse_args()
+    main(args.log_a, args.log_b, args.region, args.lag_a, args.lag_b, args.deltas, args.trials,
+         args.tick_rate, args.workers, args.seed, args.csv)
@@ -0,0 +1,284 @@
+from __future__ import division
+
+import math
+import time
+
+# Same status values as ping_logs, which is Python 3 only
+OK = 0
+LOST = 1
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch with logarithmic buckets, so every quantile is within
+    relative_accuracy of the true value. Memory only grows with the range of the values,
+    a few hundred buckets cover microseconds to minutes at 1%.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}  # bucket index -> count, bucket i holds (gamma**(i - 1), gamma**i]
+        self.zeros = 0  # Values too small for a bucket
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value <= 1e-9:
+            self.zeros += count
+        else:
+            key = int(math.ceil(math.log(value) / self._log_gamma))
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += count
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("Can only merge sketches with the same relative accuracy")
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantiles(self, qs):
+        """
+        Return the values at the quantiles qs (between 0 and 1, ascending) in one pass over the buckets.
+        """
+        if not self.count:
+            return [None] * len(qs)
+        values = []
+        ranks = iter(q * (self.count - 1) for q in qs)
+        rank = next(ranks)
+        seen = self.zeros
+        while rank is not None and rank < seen:
+            values.append(0.0)
+            rank = next(ranks, None)
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            while rank is not None and rank < seen:
+                values.append(2 * self.gamma ** key / (self.gamma + 1))
+                rank = next(ranks, None)
+            if rank is None:
+                break
+        return values
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+
+def median_interval(values, z=1.96):
+    """
+    Return (low, median, high): the median of values and a distribution free confidence interval
+    for it from the order statistics, z standard errors wide (1.96 for 95%). Lost pings can be
+    passed as float("inf"), so they count against a target instead of being ignored.
+    """
+    ordered = sorted(values)
+    n = len(ordered)
+    if not n:
+        return None, None, None
+    half_width = z * math.sqrt(n) / 2
+    low = max(int(math.floor(n / 2 - half_width)), 0)
+    high = min(int(math.ceil(n / 2 + half_width)), n - 1)
+    if n % 2:
+        median = ordered[n // 2]
+    else:
+        median = (ordered[n // 2 - 1] + ordered[n // 2]) / 2
+    return ordered[low], median, ordered[high]
+
+
+class PingStats(object):
+    """
+    Single pass statistics of the round trip times of a run, in O(1) memory: Welford's mean and
+    variance, min and max, loss, RFC 3550 jitter and a QuantileSketch for the percentiles.
+    It is a sink for probe_concurrently, or is fed with add() and add_lost() directly.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0  # Sum of squared differences from the mean
+        self.min = None
+        self.max = None
+        self.lost = 0
+        self.jitter = 0.0
+        self._last = None
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def add(self, rtt_ms):
+        self.count += 1
+        delta = rtt_ms - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (rtt_ms - self.mean)
+        if self.min is None or rtt_ms < self.min:
+            self.min = rtt_ms
+        if self.max is None or rtt_ms > self.max:
+            self.max = rtt_ms
+        if self._last is not None:
+            self.jitter += (abs(rtt_ms - self._last) - self.jitter) / 16
+        self._last = rtt_ms
+        self.sketch.add(rtt_ms)
+
+    def add_lost(self, count=1):
+        self.lost += count
+
+    def append(self, seq, send_ns, rtt_ns, status=OK, source=0):
+        if status == OK:
+            self.add(rtt_ns / 1e6)
+        else:
+            self.add_lost()
+
+    def merge(self, other):
+        """
+        Add the samples of another PingStats, e.g. of another run. The jitter becomes the
+        average of both weighted by their sample counts.
+        """
+        count = self.count + other.count
+        if other.count:
+            delta = other.mean - self.mean
+            self._m2 += other._m2 + delta * delta * self.count * other.count / count
+            self.mean += delta * other.count / count
+            self.jitter = (self.jitter * self.count + other.jitter * other.count) / count
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self.count = count
+        self.lost += other.lost
+        self.sketch.merge(other.sketch)
+
+    @property
+    def sent(self):
+        return self.count + self.lost
+
+    @property
+    def loss_percent(self):
+        return 100.0 * self.lost / self.sent if self.sent else 0.0
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.variance)
+
+    def percentiles(self, percentiles=PERCENTILES):
+        # The sketch returns bucket midpoints, which can lie just outside the exact min and max
+        values = self.sketch.quantiles([p / 100.0 for p in percentiles])
+        return [value if value is None else min(max(value, self.min), self.max) for value in values]
+
+    def summary_lines(self):
+        if not self.count:
+            return ["  - No replies, lost %d pings" % self.lost]
+        p25, p50, p75 = self.percentiles((25, 50, 75))
+        lines = [
+            "  - Max Ping: %.2f milliseconds" % self.max,
+            "  - Min Ping: %.2f milliseconds" % self.min,
+            "  - Average Ping: %.2f milliseconds" % self.mean,
+            "  - Median Ping: %.2f milliseconds" % p50,
+            "  - Standard Deviation: %.2f milliseconds" % self.stdev,
+            "  - Interquartile Range: %.2f milliseconds" % (p75 - p25),
+        ]
+        for percentile, value in zip(PERCENTILES[1:], self.percentiles(PERCENTILES[1:])):
+            lines.append("  - %s%% of pings below: %.2f milliseconds" % (percentile, value))
+        lines.append("  - Jitter: %.2f milliseconds" % self.jitter)
+        lines.append("  - Lost: %d of %d (%.2f%%)" % (self.lost, self.sent, self.loss_percent))
+        return lines
+
+    def status_line(self):
+        if not self.count:
+            return "%d pings, no replies" % self.sent
+        values = " ".join("p%s %.1f" % (p, v) for p, v in zip(PERCENTILES, self.percentiles()))
+        return "%d pings, %s ms, jitter %.1f ms, loss %.2f%%" % (self.sent, values, self.jitter, self.loss_percent)
+
+
+class LiveStats(PingStats):
+    """
+    PingStats that prints its status line every interval seconds while samples come in.
+    """
+
+    def __init__(self, interval=10, prefix="  ", relative_accuracy=0.01):
+        PingStats.__init__(self, relative_accuracy)
+        self.interval = interval
+        self.prefix = prefix
+        self._printed = time.time()
+
+    def add(self, rtt_ms):
+        PingStats.add(self, rtt_ms)
+        self._tick()
+
+    def add_lost(self, count=1):
+        PingStats.add_lost(self, count)
+        self._tick()
+
+    def _tick(self):
+        now = time.time()
+        if now - self._printed >= self.interval:
+            self._printed = now
+            print(self.prefix + self.status_line())
+
+
+class StageProfile(object):
+    """
+    How long each stage of the ping hot path took, in fixed-size log2 histograms of nanoseconds:
+    bucket i counts durations of i significant bits, [2**(i - 1), 2**i). Recording a duration is a
+    bit_length() and an increment, and memory does not grow with the run. Only one in every
+    `every` requests and packets is timed, which keeps the clock reads under 1% of a probe.
+    Stages: build (patching the packet), send (sendto), wakeup (kernel receive timestamp of a reply
+    to the return of select, only with kernel timestamps), recv (reading a packet) and parse (its header).
+    """
+    STAGES = ("build", "send", "wakeup", "recv", "parse")
+    BUCKETS = 64
+
+    def __init__(self, every=32):
+        self.every = every
+        for stage in self.STAGES:
+            setattr(self, stage, [0] * self.BUCKETS)
+
+    def histograms(self):
+        return dict((stage, getattr(self, stage)) for stage in self.STAGES)
+
+    def merge(self, other):
+        for stage in self.STAGES:
+            counts = getattr(self, stage)
+            for i, count in enumerate(getattr(other, stage)):
+                counts[i] += count
+
+    @staticmethod
+    def quantile(counts, q):
+        """
+        Return the upper bound in nanoseconds of the bucket holding quantile q, or None when empty.
+        """
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return 1 << i
+        return 1 << (len(counts) - 1)
+
+    def summary_lines(self):
+        lines = []
+        for stage in self.STAGES:
+            counts = getattr(self, stage)
+            if sum(counts):
+                bounds = [self.quantile(counts, q) / 1000.0 for q in (0.5, 0.99, 1.0)]
+                lines.append("  - %s: %d timed, p50 below %.1f us, p99 below %.1f us, max below %.1f us"
+                             % ((stage, sum(counts)) + tuple(bounds)))
+        return lines or ["  - Nothing recorded"]
+
+    def footer_lines(self, scope=None):
+        """
+        One results file line per stage, with the non-empty buckets as index:count. scope names
+        what the profile covers when it is not just the region of the file, e.g. "all regions".
+        """
+        label = "" if scope is None else " (%s)" % scope
+        lines = []
+        for stage in self.STAGES:
+            counts = getattr(self, stage)
+            if sum(counts):
+                buckets = ",".join("%d:%d" % (i, count) for i, count in enumerate(counts) if count)
+                lines.append("Hot path %s%s: p50=%d, p99=%d, buckets=%s" % (
+                    stage, label, self.quantile(counts, 0.5), self.quantile(counts, 0.99), buckets))
+        return lines
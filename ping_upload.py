@@ -0,0 +1,235 @@
+import http.client
+import json
+import os
+import random
+import tempfile
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is only offered when the zstandard package is installed
+    zstandard = None
+
+import ping_logs
+from ping_common import UPLOAD_ENDPOINT, UPLOAD_HOST
+QUEUE_FILE = 'ping_upload_queue.txt'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+CHUNK_SIZE = 1 << 16
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadResponse:
+    """
+    Status of an upload and its JSON body, or None when the server did not send JSON.
+    """
+
+    def __init__(self, status, body):
+        self.status = status
+        try:
+            self.data = json.loads(body)
+        except ValueError:
+            self.data = None
+
+    @property
+    def accepted(self):
+        return 200 <= self.status < 300
+
+    @property
+    def joke(self):
+        return self.data.get("joke") if isinstance(self.data, dict) else None
+
+
+class UploadQueue:
+    """
+    Files waiting to be sent, one absolute path per line of a text file. Any object with the same
+    queued(), add(), remove() and reject() methods, such as ping_registry.RunRegistry, can stand
+    in for it. remove() is called for files the server accepted, reject() for files it turned down.
+    """
+
+    def __init__(self, file_name=QUEUE_FILE):
+        self.file_name = file_name
+
+    def queued(self):
+        if not os.path.exists(self.file_name):
+            return []
+        with open(self.file_name, 'r') as file:
+            return [line.rstrip("\n") for line in file if line.strip()]
+
+    def _write(self, file_names):
+        if not file_names:
+            if os.path.exists(self.file_name):
+                os.remove(self.file_name)
+            return
+        with open(self.file_name, 'w') as file:
+            file.writelines(f"{file_name}\n" for file_name in file_names)
+
+    def add(self, file_name):
+        file_name = os.path.abspath(file_name)
+        if file_name not in self.queued():
+            with open(self.file_name, 'a') as file:
+                file.write(f"{file_name}\n")
+
+    def remove(self, file_name):
+        queued = self.queued()
+        if os.path.abspath(file_name) in queued:
+            self._write([queued_name for queued_name in queued if queued_name != os.path.abspath(file_name)])
+
+    def reject(self, file_name):
+        self.remove(file_name)  # Retrying would be turned down again
+
+
+class Uploader:
+    """
+    Send results files over one keep-alive connection, so uploading several files costs a single
+    TLS handshake. Files are streamed from disk, failed attempts are retried with exponential
+    backoff, and files that still fail go into an on-disk queue (an UploadQueue by default) that the
+    next run sends first. Pass tls=False and a port to point it at a local stand-in server.
+    Compression ("gzip" or "zstd") is off by default, the production endpoint is not known to decode
+    it. A compressed upload that is answered with a 4xx is sent once more as a plain body.
+    """
+
+    def __init__(self, host=UPLOAD_HOST, endpoint=UPLOAD_ENDPOINT, port=None, tls=True, timeout=30, retries=3,
+                 backoff=1.0, compression=None, queue=None):
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package, use gzip or None")
+        if compression not in ("gzip", "zstd", None):
+            raise ValueError(f"Unknown compression {compression!r}")
+        self.host = host
+        self.endpoint = endpoint
+        self.port = port
+        self.tls = tls
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.compression = compression
+        self.queue = queue if queue is not None else UploadQueue()
+        self.connection = None
+        self.connections_opened = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _connect(self):
+        if self.connection is None:
+            connection_class = http.client.HTTPSConnection if self.tls else http.client.HTTPConnection
+            self.connection = connection_class(self.host, self.port, timeout=self.timeout)
+            self.connections_opened += 1
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    @staticmethod
+    def _chunks(file_name, compression):
+        """
+        Yield the file in compressed chunks without reading it into memory as a whole.
+        """
+        if compression == "gzip":
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header
+        else:
+            compressor = zstandard.ZstdCompressor().compressobj()
+        with open(file_name, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                chunk = compressor.compress(chunk)
+                if chunk:
+                    yield chunk
+        yield compressor.flush()
+
+    def upload(self, file_name):
+        """
+        Post a file, retrying connection errors and 429/5xx answers with exponential backoff.
+        The server takes the text format, so binary logs are sent as a converted temporary copy.
+        Return the UploadResponse, or raise UploadError once the retries are used up.
+        """
+        with open(file_name, 'rb') as file:
+            binary = file.read(len(ping_logs.MAGIC)) == ping_logs.MAGIC
+        if not binary:
+            return self._post(file_name)
+        with tempfile.TemporaryDirectory() as directory:
+            return self._post(ping_logs.convert_log(file_name, os.path.join(directory, os.path.basename(file_name)), "text"))
+
+    def _post(self, file_name):
+        response = self._post_as(file_name, self.compression)
+        if self.compression and 400 <= response.status < 500:
+            # The server may not decode compressed bodies (415 or another 4xx), send it as it is
+            response = self._post_as(file_name, None)
+        return response
+
+    def _post_as(self, file_name, compression):
+        headers = {'Content-type': 'application/text'}
+        if compression:
+            headers['Content-Encoding'] = compression
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            try:
+                connection = self._connect()
+                if compression:
+                    # The compressed size is not known up front, so the body goes out chunked
+                    connection.request('POST', self.endpoint, body=self._chunks(file_name, compression),
+                                       headers=headers, encode_chunked=True)
+                else:
+                    with open(file_name, 'rb') as file:
+                        headers['Content-Length'] = str(os.fstat(file.fileno()).st_size)
+                        connection.request('POST', self.endpoint, body=file, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                if response.will_close:
+                    self.close()
+            except (OSError, http.client.HTTPException) as e:
+                # The connection may be half used, start over with a new one
+                self.close()
+                error = e
+                continue
+            if response.status in RETRY_STATUSES:
+                error = UploadError(f"Server answered {response.status} {response.reason}")
+                continue
+            return UploadResponse(response.status, body)
+        raise UploadError(f"Upload of {file_name} failed after {self.retries + 1} attempts: {error}")
+
+    def send(self, file_name):
+        """
+        Upload a file, queueing it for the next run if that fails. Return the UploadResponse, or
+        None when the file was queued.
+        """
+        try:
+            response = self.upload(file_name)
+        except UploadError:
+            self.queue.add(file_name)
+            return None
+        if response.accepted:
+            self.queue.remove(file_name)
+        else:
+            self.queue.reject(file_name)
+        return response
+
+    def send_queued(self):
+        """
+        Retry the files that earlier runs could not send. Files that fail again stay queued,
+        files that no longer exist are dropped. Return the number of files sent.
+        """
+        sent = 0
+        for file_name in self.queue.queued():
+            if not os.path.exists(file_name):
+                self.queue.remove(file_name)
+                continue
+            try:
+                response = self.upload(file_name)
+            except UploadError:
+                break  # The server is not reachable, leave the rest for the next run as well
+            if response.accepted:
+                self.queue.remove(file_name)
+                sent += 1
+            else:
+                self.queue.reject(file_name)
+        return sent